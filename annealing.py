@@ -0,0 +1,131 @@
+import math
+
+import numpy
+import tqdm
+
+from data import SamplePool
+from sampler import IsingSampler
+
+
+class AnnealingSampler(IsingSampler):
+    """
+    Samples low energy states of the model using simulated annealing. Each
+    sample is the final state of an independent restart, and the restarts
+    are run in batches as rows of a single spin matrix, updated by heat bath
+    moves one colour class at a time.
+
+    Takes:
+      - n_sweeps: Number of sweeps of every restart.
+      - schedule: Either 'geometric' or 'linear' interpolation of the inverse
+                  temperature over beta_range, or an explicit sequence of
+                  inverse temperatures, one per sweep.
+      - beta_range: A (beta_initial, beta_final) pair. Derived from the model
+                    coefficients if not given.
+      - batch_size: Number of restarts run together.
+      - seed: Seed of the random number generator, or a numpy Generator.
+      - capacity: Number of the lowest energy distinct states kept in the
+                  returned pool, all of them if None.
+    """
+
+    SCHEDULES = ('geometric', 'linear')
+
+    def __init__(self, n_sweeps=1000, schedule='geometric', beta_range=None,
+                 batch_size=1000, seed=None, capacity=None):
+        if isinstance(schedule, str) and schedule not in self.SCHEDULES:
+            raise ValueError("Unknown annealing schedule: {}".format(schedule))
+
+        self.n_sweeps = n_sweeps
+        self.schedule = schedule
+        self.beta_range = beta_range
+        self.batch_size = batch_size
+        self.rng = numpy.random.default_rng(seed)
+        self.capacity = capacity
+
+    def default_beta_range(self, compiled, temperature=None):
+        """
+        Chooses the initial inverse temperature so that even the largest local
+        field leaves the spins nearly random, and the final one so that the
+        smallest coefficient is felt strongly, or as given by the temperature.
+        """
+
+        magnitudes = numpy.abs(compiled.h) + compiled.row_sums(
+            numpy.ones(len(compiled)), compiled.indptr,
+            compiled.indices, numpy.abs(compiled.couplings)
+        )
+        coefficients = numpy.abs(numpy.concatenate([compiled.h, compiled.edge_couplings]))
+        coefficients = coefficients[coefficients > 0]
+
+        if not len(coefficients):
+            return 1.0, 1.0
+
+        beta_initial = math.log(2) / (2 * magnitudes.max())
+
+        if temperature is not None:
+            beta_final = 1.0 / temperature
+        else:
+            beta_final = math.log(100) / (2 * coefficients.min())
+
+        return beta_initial, max(beta_initial, beta_final)
+
+    def betas(self, compiled, temperature=None):
+        """
+        Returns the inverse temperature of every sweep.
+        """
+
+        if not isinstance(self.schedule, str):
+            return numpy.asarray(self.schedule, dtype=float)
+
+        beta_initial, beta_final = self.beta_range or self.default_beta_range(compiled, temperature)
+
+        if self.schedule == 'linear':
+            return numpy.linspace(beta_initial, beta_final, self.n_sweeps)
+        else:
+            return numpy.geomspace(beta_initial, beta_final, self.n_sweeps)
+
+    def anneal(self, compiled, spins, betas):
+        """
+        Anneals the (restarts, variables) spin matrix in place.
+        """
+
+        blocks = [
+            (rows, compiled.h[rows], compiled.adjacency(rows))
+            for rows in compiled.colour_classes()
+        ]
+
+        for beta in betas:
+            draws = self.rng.random(spins.shape)
+
+            for rows, biases, adjacency in blocks:
+                fields = biases + compiled.row_sums(spins, *adjacency)
+
+                # Heat bath probability of obtaining -1. Unlike Metropolis,
+                # it does not let whole colour classes oscillate through
+                # moves of zero energy change.
+                exponent = numpy.clip(-2 * beta * fields, -700, 700)
+                probabilities = 1.0 / (1.0 + numpy.exp(exponent))
+
+                spins[:, rows] = numpy.where(draws[:, rows] <= probabilities, -1, 1)
+
+    def sample(self, model, num_samples, temperature=None):
+        """
+        Runs num_samples independent restarts of the annealing and collects
+        their final states. If temperature is given, the annealing ends at
+        that temperature.
+        """
+
+        pool = SamplePool(capacity=self.capacity)
+        compiled = model.compile()
+        betas = self.betas(compiled, temperature)
+
+        for start in tqdm.trange(0, num_samples, self.batch_size):
+            size = min(self.batch_size, num_samples - start)
+
+            spins = numpy.where(
+                self.rng.random((size, len(compiled))) < 0.5, -1, 1
+            ).astype(numpy.int8)
+
+            self.anneal(compiled, spins, betas)
+
+            pool.add_states(model, spins)
+
+        return pool
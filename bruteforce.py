@@ -1,6 +1,6 @@
 import itertools
-import math
 
+import numpy
 from joblib import Parallel, delayed
 
 from sampler import IsingSampler
@@ -51,4 +51,13 @@ class BruteforceSampler(IsingSampler):
         Computes the partition function of the given mode.
         """
 
-        return sum([math.e ** (-sample.energy/float(temperature)) for sample in self.sample(model)])
+        # Evaluate the energies in blocks over the compiled model, there is no
+        # need to construct IsingSample objects for every assignment
+        compiled = model.compile()
+        partition = 0.0
+
+        for chunk in split_iterator(2 ** 14, self.generate_assignments(model)):
+            energies = compiled.energy(numpy.array(chunk))
+            partition += numpy.exp(-energies / float(temperature)).sum()
+
+        return float(partition)
@@ -1,7 +1,7 @@
+import collections
 import functools
 import heapq
 import json
-import operator
 import numpy
 import math
 
@@ -38,6 +38,9 @@ class IsingModel(LoggerMixin):
 
         self.variables = self.J.elements | set(self.h)
 
+        # Cache of the compiled, array-backed form of the model
+        self._compiled = None
+
     def clamp(self, variable, value):
         """
         Fix the given variable to the given value. This removes relevant
@@ -63,6 +66,9 @@ class IsingModel(LoggerMixin):
         # Drop the variable from the k-local space and raw space
         self.variables.discard(variable)
 
+        # The compiled form no longer reflects the model
+        self._compiled = None
+
         # Record the clamped variable
         self.clamped[variable] = value
 
@@ -100,27 +106,69 @@ class IsingModel(LoggerMixin):
 
         return copied_model
 
+    def compile(self):
+        """
+        Returns the immutable, array-backed form of the model. The result is
+        cached and invalidated by clamping.
+        """
+
+        if self._compiled is None:
+            self._compiled = CompiledIsingModel.from_model(self)
+
+        return self._compiled
+
+    def __getstate__(self):
+        """
+        Pickles the model without its compiled form, which is rebuilt on
+        demand.
+        """
+
+        state = self.__dict__.copy()
+        state['_compiled'] = None
+
+        return state
+
+    def update(self, h, edge_couplings):
+        """
+        Sets the coefficients of the model from vectors ordered as the
+        variables and the edges of its compiled form. The structure of the
+        model is kept, and so is the colouring cached by the compiled form.
+        """
+
+        if self.clamped:
+            raise ValueError("Cannot update the coefficients of a clamped model")
+
+        compiled = self.compile()
+        variables = compiled.variables
+
+        for variable, value in zip(variables, numpy.asarray(h).tolist()):
+            self.h[variable] = self.h_clamped[variable] = value
+
+        for (node1, node2), value in zip(compiled.edges.tolist(),
+                                         numpy.asarray(edge_couplings).tolist()):
+            edge = (variables[node1], variables[node2])
+            self.J[edge] = self.J_clamped[edge] = value
+
+        self._compiled = compiled.with_coefficients(h, edge_couplings)
+
     def as_dwave(self):
         """
         Reformulate the model to D-Wave representation,
         which uses the same J matrix, but uses an space-inefficient h vector
         """
 
-        # Compute the variable range
-        mapping = {
-            variable: index
-            for index, variable in enumerate(sorted(self.variables))
-        }
-
-        h_dwave = [0] * len(self.variables)
-        J_dwave = {}
-
-        # Shift all values so thae first qubit is 0
-        for (node1, node2), value in self.J_clamped.items():
-            J_dwave[(mapping[node1], mapping[node2])] = value
+        compiled = self.compile()
 
-        for index, value in self.h_clamped.items():
-            h_dwave[mapping[index]] = value
+        # The compiled model already has the variables shifted so that the
+        # first qubit is 0
+        h_dwave = compiled.h.tolist()
+        J_dwave = {
+            (node1, node2): value
+            for (node1, node2), value in zip(
+                compiled.edges.tolist(),
+                compiled.edge_couplings.tolist()
+            )
+        }
 
         return h_dwave, J_dwave
 
@@ -216,6 +264,364 @@ class IsingModel(LoggerMixin):
         return obj
 
 
+class CompiledIsingModel(object):
+    """
+    An immutable, array-backed form of an IsingModel. Free variables are
+    indexed by integers in their sorted order, the biases are stored as a
+    vector and the couplings both as a list of edges and as a symmetric CSR
+    adjacency structure.
+    """
+
+    # Finest decimal grid considered when detecting quantized coefficients
+    MAX_DECIMALS = 6
+
+    # Largest number of entries of the (states, edges) products formed at
+    # once when computing energies
+    ENERGY_BLOCK = 2 ** 22
+
+    def __init__(self, variables, h, edges, edge_couplings, energy_offset, dtype=float):
+        """
+        Initialize the compiled model. Takes:
+        - variables: A sorted sequence of the free variables.
+        - h: A vector of biases, indexed as variables.
+        - edges: A (m, 2) array of index pairs, each coupling listed once.
+        - edge_couplings: A vector of m coupling values.
+        - energy_offset: Energy contributed by the clamped variables.
+        - dtype: Type of the coefficients, integer for quantized models.
+        """
+
+        self.variables = tuple(variables)
+        self.index = {
+            variable: index
+            for index, variable in enumerate(self.variables)
+        }
+
+        # Copy the arrays, so that the caller's buffers cannot change them
+        self.h = numpy.array(h, dtype=dtype).reshape(len(self.variables))
+        self.edges = numpy.array(edges, dtype=numpy.intp).reshape(-1, 2)
+        self.edge_couplings = numpy.array(edge_couplings, dtype=dtype).reshape(-1)
+        self.energy_offset = energy_offset
+
+        # Build the CSR structure, listing every coupling in both directions
+        rows = numpy.concatenate([self.edges[:, 0], self.edges[:, 1]])
+        cols = numpy.concatenate([self.edges[:, 1], self.edges[:, 0]])
+        values = numpy.concatenate([self.edge_couplings, self.edge_couplings])
+
+        order = numpy.lexsort((cols, rows))
+        self.indices = cols[order]
+        self.couplings = values[order]
+        self.indptr = numpy.concatenate([
+            [0], numpy.cumsum(numpy.bincount(rows, minlength=len(self.variables)))
+        ]).astype(numpy.intp)
+
+        for array in (self.h, self.edges, self.edge_couplings,
+                      self.indices, self.couplings, self.indptr):
+            array.flags.writeable = False
+
+        self._colour_classes = None
+        self._quantum = None
+        self._quantized = {}
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        Compiles the clamped version of the given IsingModel.
+        """
+
+        variables = sorted(model.variables)
+        index = {variable: i for i, variable in enumerate(variables)}
+
+        h = numpy.zeros(len(variables))
+        for variable, value in model.h_clamped.items():
+            h[index[variable]] = value
+
+        edges = [
+            (index[node1], index[node2])
+            for node1, node2 in model.J_clamped
+        ]
+
+        return cls(
+            variables=variables,
+            h=h,
+            edges=edges,
+            edge_couplings=list(model.J_clamped.values()),
+            energy_offset=model.energy_offset,
+        )
+
+    def with_coefficients(self, h, edge_couplings):
+        """
+        Returns the model with the same variables and edges but the given
+        coefficients, sharing the cached colouring of the graph.
+        """
+
+        compiled = CompiledIsingModel(
+            variables=self.variables,
+            h=h,
+            edges=self.edges,
+            edge_couplings=edge_couplings,
+            energy_offset=self.energy_offset,
+        )
+        compiled._colour_classes = self._colour_classes
+
+        return compiled
+
+    def __len__(self):
+        """
+        Return the number of free variables.
+        """
+
+        return len(self.variables)
+
+    def degree(self, index):
+        """
+        Return the number of neighbours of the variable at the given index.
+        """
+
+        return self.indptr[index + 1] - self.indptr[index]
+
+    def neighbours(self, index):
+        """
+        Return the indices and couplings of the neighbours of the variable at
+        the given index.
+        """
+
+        start, end = self.indptr[index], self.indptr[index + 1]
+        return self.indices[start:end], self.couplings[start:end]
+
+    def colour_classes(self):
+        """
+        Greedily colours the interaction graph, so that no two neighbouring
+        variables share a colour. Variables are visited in breadth-first
+        order, which yields two colours for bipartite graphs such as grids.
+
+        Returns a list of index arrays, one per colour class.
+        """
+
+        if self._colour_classes is not None:
+            return self._colour_classes
+
+        indptr = self.indptr.tolist()
+        indices = self.indices.tolist()
+        colours = [None] * len(self)
+
+        for root in range(len(self)):
+            if colours[root] is not None:
+                continue
+
+            queue = collections.deque([root])
+            colours[root] = -1
+
+            while queue:
+                index = queue.popleft()
+                neighbours = indices[indptr[index]:indptr[index + 1]]
+                used = set(colours[neighbour] for neighbour in neighbours)
+
+                colour = 0
+                while colour in used:
+                    colour += 1
+                colours[index] = colour
+
+                for neighbour in neighbours:
+                    if colours[neighbour] is None:
+                        # Mark as discovered, the colour is assigned when the
+                        # variable is popped from the queue
+                        colours[neighbour] = -1
+                        queue.append(neighbour)
+
+        colours = numpy.array(colours, dtype=numpy.intp)
+        self._colour_classes = [
+            numpy.flatnonzero(colours == colour)
+            for colour in range(colours.max() + 1 if len(colours) else 0)
+        ]
+
+        return self._colour_classes
+
+    def connected_components(self, active):
+        """
+        Finds the connected components of the graph formed by the edges
+        selected by the boolean mask, using union-find.
+
+        Returns a vector assigning every variable the index of the root
+        variable of its component.
+        """
+
+        parent = list(range(len(self)))
+
+        def find(node):
+            while parent[node] != node:
+                # Path halving
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        for node1, node2 in self.edges[active].tolist():
+            root1, root2 = find(node1), find(node2)
+            if root1 != root2:
+                parent[root1] = root2
+
+        return numpy.array([find(node) for node in range(len(self))], dtype=numpy.intp)
+
+    def to_state(self, assignment):
+        """
+        Convert an assignment dictionary to a vector of spins.
+        """
+
+        return numpy.array(
+            [assignment[variable] for variable in self.variables],
+            dtype=numpy.int8
+        )
+
+    def to_assignment(self, state):
+        """
+        Convert a vector of spins to an assignment dictionary.
+        """
+
+        return dict(zip(self.variables, (int(value) for value in state)))
+
+    def adjacency(self, rows):
+        """
+        Return the (indptr, indices, couplings) CSR structure restricted to the
+        given rows, columns still refer to all the variables.
+        """
+
+        rows = numpy.asarray(rows, dtype=numpy.intp)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+
+        indptr = numpy.concatenate([[0], numpy.cumsum(lengths)]).astype(numpy.intp)
+        positions = numpy.arange(indptr[-1]) + numpy.repeat(starts - indptr[:-1], lengths)
+
+        return indptr, self.indices[positions], self.couplings[positions]
+
+    @staticmethod
+    def row_sums(states, indptr, indices, couplings):
+        """
+        Computes sum_j J_ij s_j for every row of the given CSR structure.
+        Accepts a single state vector or a (chains, variables) matrix.
+        """
+
+        states = numpy.asarray(states)
+        sums = numpy.zeros(states.shape[:-1] + (len(indptr) - 1,))
+
+        if len(indices):
+            products = states[..., indices] * couplings
+            partial = numpy.add.reduceat(
+                products,
+                numpy.minimum(indptr[:-1], len(indices) - 1),
+                axis=-1
+            )
+
+            # reduceat does not produce zeros for empty rows
+            nonempty = indptr[1:] > indptr[:-1]
+            sums[..., nonempty] = partial[..., nonempty]
+
+        return sums
+
+    def local_fields(self, states):
+        """
+        Computes the local fields h_i + sum_j J_ij s_j for all variables.
+        Accepts a single state vector or a (chains, variables) matrix.
+        """
+
+        return self.h + self.row_sums(states, self.indptr, self.indices, self.couplings)
+
+    def quantum(self):
+        """
+        Detects whether all the coefficients lie on a decimal grid, such as
+        the ones produced by RandomBuilder and ImageBuilder, and returns the
+        coarsest such grid spacing. Returns None for other models.
+        """
+
+        if self._quantum is None:
+            self._quantum = False
+
+            coefficients = numpy.concatenate([
+                self.h, self.edge_couplings, [self.energy_offset]
+            ]).astype(float)
+
+            for decimals in range(self.MAX_DECIMALS + 1):
+                scaled = coefficients * 10 ** decimals
+                if numpy.all(numpy.abs(scaled - numpy.rint(scaled)) < 1e-6):
+                    self._quantum = 10.0 ** -decimals
+                    break
+
+        return self._quantum or None
+
+    def quantized(self, quantum):
+        """
+        Returns the model with all its coefficients expressed as integer
+        multiples of the given quantum.
+        """
+
+        if quantum not in self._quantized:
+            coefficients = [
+                numpy.asarray(self.h, dtype=float) / quantum,
+                numpy.asarray(self.edge_couplings, dtype=float) / quantum,
+                numpy.array([self.energy_offset], dtype=float) / quantum,
+            ]
+
+            if any(numpy.any(numpy.abs(c - numpy.rint(c)) > 1e-6) for c in coefficients):
+                raise ValueError("Model coefficients are not multiples of {}".format(quantum))
+
+            h, edge_couplings, energy_offset = [
+                numpy.rint(c).astype(numpy.int64) for c in coefficients
+            ]
+
+            self._quantized[quantum] = CompiledIsingModel(
+                variables=self.variables,
+                h=h,
+                edges=self.edges,
+                edge_couplings=edge_couplings,
+                energy_offset=int(energy_offset[0]),
+                dtype=numpy.int64,
+            )
+
+        return self._quantized[quantum]
+
+    def energy(self, states):
+        """
+        Return the energy of a single state vector or of every row of
+        a (chains, variables) matrix.
+
+        Energies of quantized models are computed exactly in integers, so that
+        equal energies are always represented by the same float. The rows are
+        processed in blocks, bounding the temporary arrays by ENERGY_BLOCK.
+        """
+
+        quantum = self.quantum()
+        if quantum is not None and self.h.dtype.kind == 'f':
+            # Dividing by the integer reciprocal keeps the decimal digits exact
+            return self.quantized(quantum).energy(states) / round(1 / quantum)
+
+        states = numpy.asarray(states, dtype=numpy.int8)
+        flat = states.reshape(int(numpy.prod(states.shape[:-1])), states.shape[-1])
+        rows = max(1, self.ENERGY_BLOCK // max(1, len(self.edges)))
+
+        energies = numpy.concatenate([
+            self.block_energy(flat[start:start + rows])
+            for start in range(0, len(flat), rows)
+        ] or [numpy.zeros(0)])
+
+        return energies.reshape(states.shape[:-1])[()]
+
+    def block_energy(self, states):
+        """
+        Computes the energies of the rows of a (chains, variables) matrix in
+        floating point, which is exact for integer coefficients as long as
+        every partial sum stays below 2^53, whatever the order of summation.
+        """
+
+        h = numpy.asarray(self.h, dtype=float)
+        couplings = numpy.asarray(self.edge_couplings, dtype=float)
+
+        # Gathering the rows of the (variables, chains) matrix is much faster
+        # than gathering its columns
+        spins = numpy.ascontiguousarray(states.T)
+        pairs = spins[self.edges[:, 0]] * spins[self.edges[:, 1]]
+
+        return self.energy_offset + h.dot(spins) + couplings.dot(pairs)
+
+
 @functools.total_ordering
 class IsingSample(object):
     """
@@ -266,6 +672,23 @@ class IsingSample(object):
         # Cache the energy of the sample
         self.energy = self.compute_energy()
 
+    @classmethod
+    def from_state(cls, model, state, occurences=1, energy=None):
+        """
+        Constructs the sample from a vector of spins over the compiled
+        variables of the model, skipping the validation of the assignment.
+        """
+
+        compiled = model.compile()
+
+        sample = cls.__new__(cls)
+        sample.model = model
+        sample.occurences = occurences
+        sample.assignment = hashabledict(cls.expand_sample(model, compiled.to_assignment(state)))
+        sample.energy = sample.compute_energy() if energy is None else energy
+
+        return sample
+
     @staticmethod
     def expand_sample(model, sample):
         """
@@ -282,15 +705,8 @@ class IsingSample(object):
         Return the energy of the given sample.
         """
 
-        energy = self.model.energy_offset
-
-        for key, value in self.model.J_clamped.items():
-            energy += functools.reduce(operator.mul, [self.assignment[k] for k in key], value)
-
-        for key, value in self.model.h_clamped.items():
-            energy += self.assignment[key] * value
-
-        return energy
+        compiled = self.model.compile()
+        return float(compiled.energy(compiled.to_state(self.assignment)))
 
     @property
     def as_tuple(self):
@@ -331,7 +747,7 @@ class IsingSample(object):
         if self.energy != other.energy:
             return self.energy < other.energy
         else:
-            return self.assignment < other.assignment
+            return self.as_tuple < other.as_tuple
 
     def __eq__(self, other):
         """
@@ -358,23 +774,81 @@ class IsingSample(object):
 
 class SamplePool(object):
     """
-    A data structure to keep the N best samples.
+    A data structure to keep the distinct samples of a model and their
+    numbers of occurences, ordered from the best (lowest energy) one.
+
+    The pool is columnar: the states are stored as bit-packed rows over the
+    compiled variables of the model, next to arrays of their energies and
+    counts, and deduplicated through a dict keyed by the packed rows.
+    IsingSample objects are only created when the samples are accessed.
+
+    If a capacity is given, only that many distinct samples of the lowest
+    energies are kept. A heap of the kept rows finds the worst one, which is
+    evicted when a better sample arrives; new samples which are not better
+    than the worst kept one when the pool is full are not stored at all.
+    Their occurences still count towards the length and the mean energy of the
+    pool, and are summed up in evicted and evicted_energy_sum.
+
+    The mean and the variance of the energy and the energy histogram are
+    updated as the samples are added, over every occurence including the
+    evicted ones, so that they take neither a scan of the pool nor memory
+    per occurence.
     """
 
-    def __init__(self, data=None):
+    def __init__(self, data=None, capacity=None, bin_width=None):
         """
-        Initialize the SamplePool.
+        Initialize the SamplePool. Takes:
+          - data: Samples to add.
+          - capacity: Maximum number of distinct samples kept, unbounded if
+                      None.
+          - bin_width: Width of the bins of the energy histogram, centered
+                       on the multiples of the width. By default the
+                       energies are binned by their value, rounded to the
+                       precision of CompiledIsingModel.MAX_DECIMALS.
         """
 
-        # We're using both heap (for sorting and min-max extraction) as well as
-        # dictionary (for easy access to the samples in the pool. Memory
-        # overhead is small as dictionary only stores pointers to the
-        # IsingSample objects.
+        if capacity is not None and capacity < 0:
+            raise ValueError("Capacity of the pool must be nonnegative")
+
+        # The model and its compiled form are taken from the first sample
+        self.model = None
+        self.compiled = None
+
+        # Columns of the distinct samples, in the order of insertion, with
+        # spare capacity to grow into
+        self.size = 0
+        self.rows = numpy.zeros((0, 0), dtype=numpy.uint8)
+        self.energies = numpy.zeros(0)
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+
+        # Index of the packed rows and running totals
+        self.index = dict()
+        self.total = 0
 
-        self.heap = list()
-        self.dict = dict()
+        # Welford accumulators of the energy over the occurences, the mean
+        # and the sum of the squared deviations from it, and the histogram
+        self.energy_mean = 0.0
+        self.energy_m2 = 0.0
+        self.bin_width = bin_width
+        self.histogram = defaultdict(int)
+
+        # Order of the samples from the best one, computed on demand
+        self._order = None
+
+        # Max-heap of the kept rows of a bounded pool, by energy and then
+        # by the latest insertion, and the mass of the samples not kept
+        self.capacity = capacity
+        self.heap = []
+        self.insertions = 0
+        self.evicted = 0
+        self.evicted_energy_sum = 0.0
+
+        # Sampler specific diagnostics of the run which produced the pool
+        self.diagnostics = dict()
+
+        # SpinMoments accumulated during the run, if requested
+        self.moments = None
 
-        # Rearrange the data so that it is ordered as a heap
         data = data or []
         for sample in data:
             self.add(sample)
@@ -384,36 +858,374 @@ class SamplePool(object):
         Return the number of samples in the pool.
         """
 
-        return sum([sample.occurences for sample in self.heap])
+        return self.total
 
     def __getitem__(self, key):
         """
-        Returns the slices of the pool.
+        Returns the sample at the given position, or the list of samples of
+        a slice, the best sample being first.
         """
 
-        return self.heap[key]
+        order = self.order()
+
+        if isinstance(key, slice):
+            return [self.sample(row) for row in order[key].tolist()]
+
+        return self.sample(int(order[key]))
+
+    def __iter__(self):
+        """
+        Iterates over the distinct samples, from the best one.
+        """
+
+        for row in self.order().tolist():
+            yield self.sample(row)
+
+    def order(self):
+        """
+        Returns the rows ordered by increasing energy, ties being ordered by
+        their assignments as in IsingSample comparisons.
+        """
+
+        if self._order is None:
+            rows = self.rows[:self.size]
+            keys = tuple(rows[:, ::-1].T) + (self.energies[:self.size],)
+            self._order = numpy.lexsort(keys)
+
+        return self._order
+
+    def sample(self, row):
+        """
+        Returns the IsingSample of the given row.
+        """
+
+        return IsingSample.from_state(
+            self.model, self.states(row), int(self.counts[row]), float(self.energies[row])
+        )
+
+    def states(self, rows=slice(None)):
+        """
+        Returns the int8 states of the given rows over the compiled variables.
+        """
+
+        bits = numpy.unpackbits(self.rows[:self.size][rows], axis=-1, count=len(self.compiled))
+        return numpy.where(bits, 1, -1).astype(numpy.int8)
+
+    def bind(self, model):
+        """
+        Attaches the pool to the model of its samples.
+        """
+
+        if self.model is None:
+            self.model = model
+            self.compiled = model.compile()
+            self.rows = numpy.zeros((0, (len(self.compiled) + 7) // 8), dtype=numpy.uint8)
+
+    def reserve(self, size):
+        """
+        Grows the columns to hold at least the given number of rows.
+        """
+
+        capacity = len(self.counts)
+        if size <= capacity:
+            return
+
+        capacity = max(size, 2 * capacity, 16)
+        grow = lambda array: numpy.concatenate([
+            array, numpy.zeros((capacity - len(array),) + array.shape[1:], dtype=array.dtype)
+        ])
+
+        self.rows = grow(self.rows)
+        self.energies = grow(self.energies)
+        self.counts = grow(self.counts)
 
     def add(self, sample):
         """
         Add the Sample to the pool, making sure to deduplicate by aggregation.
         """
 
-        # First check if the sample is already in the pool, if yes, just
-        # add the occurences
-        if sample.as_tuple in self.dict:
-            present = self.dict[sample.as_tuple]
-            present.occurences += int(sample.occurences)
+        self.bind(sample.model)
+        state = self.compiled.to_state(sample.assignment)
+
+        self.add_states(sample.model, state, [sample.occurences], [sample.energy])
+
+    def add_states(self, model, states, counts=None, energies=None):
+        """
+        Adds the rows of a (samples, variables) matrix of states over the
+        compiled variables of the model, each occuring once unless counts are
+        given. The energies are computed unless given.
+        """
+
+        self.bind(model)
+
+        states = numpy.atleast_2d(states)
+        counts = numpy.ones(len(states), dtype=numpy.int64) if counts is None \
+            else numpy.asarray(counts, dtype=numpy.int64).reshape(-1)
+        energies = self.compiled.energy(states) if energies is None else energies
+        energies = numpy.asarray(energies, dtype=float).reshape(-1)
+
+        self.insert(numpy.packbits(states > 0, axis=1), counts, energies)
+        self.accumulate(energies, counts)
+
+    def insert(self, packed, counts, energies):
+        """
+        Stores the packed states with their counts and energies, without
+        updating the energy statistics.
+        """
+
+        if self.capacity is not None:
+            return self.insert_bounded(packed, counts, energies)
+
+        # Find the row of every state, appending the new ones
+        positions = numpy.empty(len(packed), dtype=numpy.intp)
+        new = []
+
+        for number, row in enumerate(packed):
+            key = row.tobytes()
+            position = self.index.get(key)
+
+            if position is None:
+                position = self.index[key] = self.size + len(new)
+                new.append(number)
+
+            positions[number] = position
+
+        if new:
+            self.reserve(self.size + len(new))
+            added = slice(self.size, self.size + len(new))
+
+            self.rows[added] = packed[new]
+            self.energies[added] = energies[new]
+
+            self.size += len(new)
+            self._order = None
+
+        numpy.add.at(self.counts, positions, counts)
+
+    def insert_bounded(self, packed, counts, energies):
+        """
+        Stores the packed states in a pool of limited capacity, one at a
+        time.
+        """
+
+        for row, count, energy in zip(packed, counts.tolist(), energies.tolist()):
+            key = row.tobytes()
+            position = self.index.get(key)
+
+            if position is None:
+                position = self.admit(key, row, energy)
+
+            if position is None:
+                self.evicted += count
+                self.evicted_energy_sum += energy * count
+            else:
+                self.counts[position] += count
+
+    def accumulate(self, energies, counts):
+        """
+        Updates the energy statistics with a batch of energies occuring the
+        given numbers of times.
+        """
+
+        count = int(counts.sum())
+        if not count:
+            return
+
+        mean = float(energies.dot(counts)) / count
+        self.combine(count, mean, float(((energies - mean) ** 2).dot(counts)))
+
+        bins, inverse = numpy.unique(self.bin(energies), return_inverse=True)
+        sums = numpy.bincount(inverse.reshape(-1), weights=counts, minlength=len(bins))
+        for energy, occurences in zip(bins.tolist(), sums.astype(numpy.int64).tolist()):
+            self.histogram[energy] += occurences
+
+    def combine(self, count, mean, m2):
+        """
+        Combines the running energy moments with the ones of count further
+        occurences, as in the parallel variant of Welford's algorithm.
+        """
+
+        if not count:
             return
 
-        heapq.heappush(self.heap, sample)
-        self.dict[sample.as_tuple] = sample
+        total = self.total + count
+        delta = mean - self.energy_mean
+
+        self.energy_mean += delta * count / total
+        self.energy_m2 += m2 + delta ** 2 * self.total * count / total
+        self.total = total
+
+    def bin(self, energies):
+        """
+        Returns the centers of the histogram bins of the energies.
+        """
+
+        if self.bin_width is None:
+            return numpy.round(energies, CompiledIsingModel.MAX_DECIMALS)
+
+        return numpy.round(energies / self.bin_width) * self.bin_width
+
+    def admit(self, key, row, energy):
+        """
+        Stores a new packed state in a bounded pool, evicting the worst kept
+        state if the pool is full. Returns the row of the state, or None if
+        it is not better than any of the kept ones.
+        """
+
+        if self.size < self.capacity:
+            self.reserve(self.size + 1)
+            position = self.size
+            self.size += 1
+        elif self.heap and energy < -self.heap[0][0]:
+            _, _, position = heapq.heappop(self.heap)
+            del self.index[self.rows[position].tobytes()]
+
+            count = int(self.counts[position])
+            self.evicted += count
+            self.evicted_energy_sum += float(self.energies[position]) * count
+            self.counts[position] = 0
+        else:
+            return None
+
+        self.rows[position] = row
+        self.energies[position] = energy
+        self.index[key] = position
+
+        # Ties in energy evict the latest of the kept samples first
+        self.insertions += 1
+        heapq.heappush(self.heap, (-energy, -self.insertions, position))
+        self._order = None
+
+        return position
+
+    def to_wire(self):
+        """
+        Returns the pool in a compact form for transfer between processes or
+        storage, as a dict of arrays: the bit-packed distinct states, their
+        counts and energies, and the running statistics. The model is not
+        included, see from_wire().
+        """
+
+        bins = numpy.array(list(self.histogram.keys()), dtype=float)
+        occurences = numpy.array(list(self.histogram.values()), dtype=numpy.int64)
+
+        return {
+            'rows': self.rows[:self.size].copy(),
+            'counts': self.counts[:self.size].copy(),
+            'energies': self.energies[:self.size].copy(),
+            'total': self.total,
+            'energy_mean': self.energy_mean,
+            'energy_m2': self.energy_m2,
+            'evicted': self.evicted,
+            'evicted_energy_sum': self.evicted_energy_sum,
+            'histogram_energies': bins,
+            'histogram_counts': occurences,
+        }
+
+    @classmethod
+    def from_wire(cls, model, wire, capacity=None, bin_width=None):
+        """
+        Builds the pool of the model from the output of to_wire().
+        """
+
+        pool = cls(capacity=capacity, bin_width=bin_width)
+        pool.merge_wire(model, wire)
+
+        return pool
+
+    def merge_wire(self, model, wire):
+        """
+        Merges the output of to_wire() of a pool of the same model into the
+        pool. The states are neither validated nor scored again, the cost is
+        linear in the number of distinct states.
+        """
+
+        self.bind(model)
+
+        rows = numpy.asarray(wire['rows'], dtype=numpy.uint8)
+        if len(rows) and rows.shape[1:] != self.rows.shape[1:]:
+            raise ValueError("Pool does not match the {} variables of the model"
+                             .format(len(self.compiled)))
+
+        self.insert(
+            rows.reshape(-1, self.rows.shape[1]),
+            numpy.asarray(wire['counts'], dtype=numpy.int64),
+            numpy.asarray(wire['energies'], dtype=float)
+        )
+
+        self.combine(int(wire['total']), float(wire['energy_mean']), float(wire['energy_m2']))
+        self.evicted += int(wire['evicted'])
+        self.evicted_energy_sum += float(wire['evicted_energy_sum'])
+
+        # Rebin the histogram if the bins of the pools differ
+        bins = self.bin(numpy.asarray(wire['histogram_energies'], dtype=float))
+        for energy, occurences in zip(bins.tolist(), numpy.asarray(wire['histogram_counts']).tolist()):
+            self.histogram[energy] += occurences
+
+    def merge(self, other):
+        """
+        Merges the samples and the statistics of another pool of the same
+        model into the pool, and returns it.
+        """
+
+        if other.model is not None:
+            self.merge_wire(other.model, other.to_wire())
+
+        return self
+
+    def __getstate__(self):
+        """
+        Pickles the pool in its wire format, the index and the cached
+        orders being rebuilt when unpickled.
+        """
+
+        return {
+            'model': self.model,
+            'capacity': self.capacity,
+            'bin_width': self.bin_width,
+            'wire': self.to_wire(),
+            'diagnostics': self.diagnostics,
+            'moments': self.moments,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(capacity=state['capacity'], bin_width=state['bin_width'])
+
+        if state['model'] is not None:
+            self.merge_wire(state['model'], state['wire'])
+
+        self.diagnostics = state['diagnostics']
+        self.moments = state['moments']
+
+    @classmethod
+    def from_arrays(cls, model, states, counts):
+        """
+        Builds the pool from an int8 matrix of distinct states over the
+        compiled variables of the model and the vector of their counts.
+        """
+
+        pool = cls()
+        pool.add_states(model, states, counts)
+
+        return pool
+
+    def as_arrays(self, compiled):
+        """
+        Returns the distinct states as an int8 matrix over the compiled
+        variables together with the vector of their counts.
+        """
+
+        if self.model is None:
+            return numpy.zeros((0, len(compiled)), dtype=numpy.int8), numpy.zeros(0, dtype=numpy.int64)
+
+        return self.states(), self.counts[:self.size].copy()
 
     def n_best(self, number):
         """
         Retrieve the N best samples.
         """
 
-        return heapq.nlargest(number, self.heap)
+        return self[:number]
 
     def to_energy_histogram(self):
         """
@@ -421,21 +1233,25 @@ class SamplePool(object):
         """
 
         histogram = defaultdict(int)
-        for sample in self.heap:
-            histogram[sample.energy] += sample.occurences
+        histogram.update(self.histogram)
 
         return histogram
 
+    def energy_density(self, temperature):
+        """
+        Estimates the density of states from the energy histogram of samples
+        drawn at the given temperature, see EnergyDensity.
+        """
+
+        return EnergyDensity.from_pools({temperature: self})
+
     @property
     def raw_data(self):
         """
         Return the raw sample list.
         """
 
-        return sum([
-            [sample.energy] * sample.occurences
-            for sample in self.heap
-        ], [])
+        return numpy.repeat(self.energies[:self.size], self.counts[:self.size]).tolist()
 
     @property
     def mean_energy(self):
@@ -443,34 +1259,275 @@ class SamplePool(object):
         Return the mean energy in the pool.
         """
 
-        return numpy.average(self.raw_data)
+        return self.energy_mean if self.total else float('nan')
 
-    def KL_divergence(self, partition_function, temperature):
+    @property
+    def energy_variance(self):
         """
-        Return the KL divergence to the idealized Boltzmann distribution.
+        Return the variance of the energy in the pool.
         """
 
-        num_samples = len(self)
+        return self.energy_m2 / self.total if self.total else float('nan')
+
+    def specific_heat(self, temperature):
+        """
+        Returns the specific heat Var(E) / T^2 of the samples, assuming they
+        were drawn at the given temperature.
+        """
 
-        boltz_prob = lambda sample: (math.e ** (-sample.energy/float(temperature))) / float(partition_function)
-        data_prob = lambda sample: sample.occurences / float(num_samples)
+        return self.energy_variance / float(temperature) ** 2
 
-        return sum([
-            data_prob(sample) * math.log10(data_prob(sample) / boltz_prob(sample))
-            for sample in self.heap
-        ])
+    def probabilities(self, partition_function, temperature, sampled=None):
+        """
+        Returns the empirical and the Boltzmann probabilities of the distinct
+        samples.
 
-    def reverse_KL_divergence(self, partition_function, temperature):
+        If the samples were drawn at another temperature, given as sampled,
+        the counts of the distinct samples are reweighted by
+        exp(-(1 / temperature - 1 / sampled) E), estimating the empirical
+        probabilities at the temperature without sampling it.
         """
-        Return the KL divergence to the idealized Boltzmann distribution.
+
+        energies = self.energies[:self.size]
+
+        if sampled is None:
+            data = self.counts[:self.size] / float(self.total)
+        else:
+            log_weights = numpy.log(self.counts[:self.size]) - \
+                (1.0 / temperature - 1.0 / sampled) * energies
+            data = numpy.exp(log_weights - EnergyDensity.logsumexp(log_weights))
+
+        boltzmann = numpy.exp(-energies / float(temperature)) / float(partition_function)
+
+        return data, boltzmann
+
+    def KL_divergence(self, partition_function, temperature, sampled=None):
+        """
+        Return the KL divergence to the idealized Boltzmann distribution,
+        see probabilities() for samples drawn at another temperature.
         """
 
-        num_samples = len(self)
+        data, boltzmann = self.probabilities(partition_function, temperature, sampled)
+        return float(numpy.sum(data * numpy.log10(data / boltzmann)))
 
-        boltz_prob = lambda sample: (math.e ** (-sample.energy/float(temperature))) / float(partition_function)
-        data_prob = lambda sample: sample.occurences / float(num_samples)
+    def reverse_KL_divergence(self, partition_function, temperature, sampled=None):
+        """
+        Return the KL divergence to the idealized Boltzmann distribution,
+        see probabilities() for samples drawn at another temperature.
+        """
 
-        return sum([
-            boltz_prob(sample) * math.log10(boltz_prob(sample) / data_prob(sample))
-            for sample in self.heap
-        ])
+        data, boltzmann = self.probabilities(partition_function, temperature, sampled)
+        return float(numpy.sum(boltzmann * numpy.log10(boltzmann / data)))
+
+
+class SpinMoments(object):
+    """
+    Accumulates the means <s_i> of the free variables and <s_i s_j> of the
+    edges of a compiled model over the recorded states, without storing
+    them.
+
+    The estimates are Rao-Blackwellized: every spin contributes its
+    conditional mean -tanh(f_i / T) given the rest of the state, and every
+    edge the average of s_i <s_j | rest> and <s_i | rest> s_j, which have
+    the same expectations as the spins but a lower variance.
+    """
+
+    def __init__(self, compiled, temperature):
+        """
+        Initialize the accumulator. Takes:
+        - compiled: The CompiledIsingModel of the states.
+        - temperature: Temperature of the states, or a vector with one
+                       temperature per row of the recorded matrices.
+        """
+
+        self.compiled = compiled
+        self.temperature = temperature
+
+        self.count = 0
+        self.spin_sums = numpy.zeros(len(compiled))
+        self.pair_sums = numpy.zeros(len(compiled.edges))
+
+    @property
+    def variables(self):
+        """
+        Variables of the magnetization vector.
+        """
+
+        return self.compiled.variables
+
+    @property
+    def edges(self):
+        """
+        Pairs of variables of the correlation vector.
+        """
+
+        variables = self.compiled.variables
+        return [(variables[node1], variables[node2]) for node1, node2 in self.compiled.edges.tolist()]
+
+    def add(self, states):
+        """
+        Adds a (chains, variables) matrix of states.
+        """
+
+        states = numpy.atleast_2d(states)
+        temperatures = numpy.reshape(numpy.asarray(self.temperature, dtype=float), (-1, 1))
+
+        means = -numpy.tanh(self.compiled.local_fields(states) / temperatures)
+        node1, node2 = self.compiled.edges[:, 0], self.compiled.edges[:, 1]
+
+        self.count += len(states)
+        self.spin_sums += means.sum(axis=0)
+        self.pair_sums += 0.5 * (
+            states[:, node1] * means[:, node2] + means[:, node1] * states[:, node2]
+        ).sum(axis=0)
+
+    def update(self, other):
+        """
+        Adds the sums accumulated by another accumulator of the same model.
+        """
+
+        self.count += other.count
+        self.spin_sums += other.spin_sums
+        self.pair_sums += other.pair_sums
+
+    @property
+    def magnetization(self):
+        """
+        Vector of the estimated <s_i>, ordered as variables.
+        """
+
+        return self.spin_sums / max(self.count, 1)
+
+    @property
+    def correlations(self):
+        """
+        Vector of the estimated <s_i s_j>, ordered as edges.
+        """
+
+        return self.pair_sums / max(self.count, 1)
+
+
+class EnergyDensity(object):
+    """
+    The density of states g(E) over the sampled energies, estimated from
+    energy histograms of samples drawn at known temperatures. It reweights
+    the samples to estimate Boltzmann averages at other temperatures,
+    P_T(E) being proportional to g(E) exp(-E / T).
+
+    The estimates are reliable only at temperatures whose typical energies
+    were sampled well, near the sampled temperatures or between them.
+    """
+
+    def __init__(self, energies, log_density):
+        """
+        Initialize the density. Takes:
+        - energies: A vector of the distinct sampled energies.
+        - log_density: Logarithm of the density of states at every energy,
+                       up to an additive constant.
+        """
+
+        self.energies = numpy.asarray(energies, dtype=float)
+        self.log_density = numpy.asarray(log_density, dtype=float)
+
+    @staticmethod
+    def logsumexp(values, axis=None):
+        """
+        Computes log(sum(exp(values))) without overflow.
+        """
+
+        values = numpy.asarray(values, dtype=float)
+        maximum = numpy.max(values, axis=axis, keepdims=True)
+        maximum = numpy.where(numpy.isfinite(maximum), maximum, 0)
+
+        result = numpy.log(numpy.sum(numpy.exp(values - maximum), axis=axis, keepdims=True))
+        return numpy.squeeze(result + maximum, axis=axis)
+
+    @classmethod
+    def from_pools(cls, pools, tolerance=1e-10, max_iterations=10000):
+        """
+        Combines the energy histograms of pools sampled at different
+        temperatures, given as a dict of SamplePools keyed by temperature
+        such as returned by GibbsSampler.sample_temperatures(), with the
+        multiple histogram method (WHAM). With a single pool, this is plain
+        single histogram reweighting.
+        """
+
+        temperatures = sorted(pools)
+        histograms = [pools[temperature].to_energy_histogram() for temperature in temperatures]
+
+        energies = numpy.array(sorted(set().union(*histograms)), dtype=float)
+        counts = numpy.array([
+            [histogram.get(energy, 0) for energy in energies.tolist()]
+            for histogram in histograms
+        ], dtype=float)
+
+        betas = 1.0 / numpy.array(temperatures, dtype=float)
+        log_totals = numpy.log(counts.sum(axis=1))
+        log_counts = numpy.log(counts.sum(axis=0))
+
+        # Iterate the self-consistent equations for the free energies
+        # f_k = -log Z_k, fixing f_0 = 0
+        free_energies = numpy.zeros(len(temperatures))
+
+        for _ in range(max_iterations):
+            log_density = log_counts - cls.logsumexp(
+                log_totals[:, None] + free_energies[:, None] - betas[:, None] * energies,
+                axis=0
+            )
+            updated = -cls.logsumexp(log_density - betas[:, None] * energies, axis=1)
+            updated -= updated[0]
+
+            converged = numpy.max(numpy.abs(updated - free_energies)) < tolerance
+            free_energies = updated
+
+            if converged:
+                break
+
+        return cls(energies, log_density)
+
+    def log_partition_function(self, temperature):
+        """
+        Returns log Z at the temperature, up to the additive constant common
+        to all temperatures.
+        """
+
+        return float(self.logsumexp(self.log_density - self.energies / float(temperature)))
+
+    def partition_function_ratio(self, temperature, reference):
+        """
+        Returns Z(temperature) / Z(reference). With the partition function
+        known at the reference temperature, it can be carried over to the
+        nearby ones.
+        """
+
+        return math.exp(
+            self.log_partition_function(temperature) - self.log_partition_function(reference)
+        )
+
+    def probabilities(self, temperature):
+        """
+        Returns the estimated probabilities of the energies at the
+        temperature.
+        """
+
+        log_weights = self.log_density - self.energies / float(temperature)
+        return numpy.exp(log_weights - self.logsumexp(log_weights))
+
+    def mean_energy(self, temperature):
+        """
+        Returns the estimated mean energy at the temperature.
+        """
+
+        return float(self.probabilities(temperature).dot(self.energies))
+
+    def specific_heat(self, temperature):
+        """
+        Returns the estimated specific heat (<E^2> - <E>^2) / T^2 at the
+        temperature.
+        """
+
+        probabilities = self.probabilities(temperature)
+        mean = probabilities.dot(self.energies)
+        variance = probabilities.dot((self.energies - mean) ** 2)
+
+        return float(variance / float(temperature) ** 2)
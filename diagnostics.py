@@ -0,0 +1,89 @@
+"""
+Convergence diagnostics of Markov chains, computed from traces of a scalar
+observable (such as the energy) given as (chains, iterations) arrays.
+"""
+
+import numpy
+
+
+def split_rhat(traces):
+    """
+    Computes the split potential scale reduction factor R-hat. Every chain
+    is split in halves, so that a single chain can be diagnosed as well.
+    Values close to 1 indicate that the chains agree.
+    """
+
+    traces = numpy.atleast_2d(numpy.asarray(traces, dtype=float))
+    length = traces.shape[1] // 2
+
+    if length < 2:
+        return float('inf')
+
+    halves = numpy.concatenate([traces[:, :length], traces[:, -length:]])
+
+    within = halves.var(axis=1, ddof=1).mean()
+    between = halves.mean(axis=1).var(ddof=1)
+
+    if within == 0:
+        # Constant traces agree only if they are all the same
+        return 1.0 if between == 0 else float('inf')
+
+    pooled = (length - 1) / float(length) * within + between
+    return float(numpy.sqrt(pooled / within))
+
+
+def autocorrelation(traces):
+    """
+    Returns the normalized autocorrelation function averaged over chains,
+    which is empty for empty traces.
+    """
+
+    traces = numpy.atleast_2d(numpy.asarray(traces, dtype=float))
+    length = traces.shape[1]
+
+    if not length or not len(traces):
+        return numpy.zeros(length)
+
+    centered = traces - traces.mean(axis=1, keepdims=True)
+
+    # Zero-padded FFT to obtain the linear (not circular) correlation
+    size = 2 ** int(numpy.ceil(numpy.log2(2 * length)))
+    spectrum = numpy.fft.rfft(centered, n=size, axis=1)
+    correlation = numpy.fft.irfft(spectrum * spectrum.conjugate(), n=size, axis=1)
+    correlation = correlation[:, :length].mean(axis=0)
+
+    if correlation[0] == 0:
+        return numpy.eye(1, length).reshape(length)
+
+    return correlation / correlation[0]
+
+
+def autocorrelation_time(traces, window=5):
+    """
+    Estimates the integrated autocorrelation time using the automatic
+    windowing of Sokal: the sum is cut off at the smallest lag M satisfying
+    M >= window * tau(M). Traces too short to tell give 1.
+    """
+
+    rho = autocorrelation(traces)
+    if not len(rho):
+        return 1.0
+
+    taus = 2 * numpy.cumsum(rho) - 1
+
+    lags = numpy.arange(len(taus))
+    cutoff = lags >= window * taus
+
+    if cutoff.any():
+        return float(max(taus[numpy.argmax(cutoff)], 1.0))
+
+    return float(max(taus[-1], 1.0))
+
+
+def effective_sample_size(traces):
+    """
+    Returns the number of effectively independent samples in the traces.
+    """
+
+    traces = numpy.atleast_2d(numpy.asarray(traces, dtype=float))
+    return traces.size / autocorrelation_time(traces)
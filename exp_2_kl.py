@@ -1,5 +1,6 @@
 import pandas
 import datetime
+import random
 import seaborn
 import matplotlib.pyplot as plt
 
@@ -14,6 +15,10 @@ from util import save_experiment
 def main():
     res = []
 
+    # Fix the models and the Gibbs chains, so that runs can be compared
+    seed = 2017
+    random.seed(seed)
+
     for width in range(1,2):
         for height in range(width, 3):
             model_width = width * 2
@@ -21,6 +26,7 @@ def main():
             decimals = 2
             temperature = 1
             runs = 2
+            chains = 16
             print("{} x {}".format(model_width, model_height))
 
             # Create the model
@@ -41,8 +47,10 @@ def main():
             embedding = builder.embedding_four()
             results_dwave_four = [sampler.sample(model, 10000, temperature, embedding=embedding) for _ in range(runs)]
 
-            sampler = GibbsSampler(n_variables=model_width*model_height)
-            results_gibbs = [sampler.sample(model, 10000, temperature) for _ in range(runs)]
+            # Advance a batch of chains together, so that the interpreter
+            # overhead of each sweep is shared among them
+            sampler = GibbsSampler(n_variables=model_width*model_height, seed=seed)
+            results_gibbs = [sampler.sample(model, 10000, temperature, n_chains=chains) for _ in range(runs)]
 
             compute_kl = lambda r_list: [r.KL_divergence(Z, temperature) for r in r_list]
 
@@ -1,11 +1,17 @@
 #!/usr/bin/python3
-import itertools
+import json
 import math
-import random
+import os
+import time
 
+import numpy
 import tqdm
+from joblib import Parallel, delayed, effective_n_jobs
 
-from data import IsingSample, SamplePool
+from data import IsingSample, SamplePool, SpinMoments
+from diagnostics import autocorrelation_time, split_rhat
+import kernels
+from multispin import MultispinLattice, PackedSpins
 from sampler import IsingSampler
 
 
@@ -17,13 +23,118 @@ class GibbsSampler(IsingSampler):
 
     Takes:
       - burnin: A number of steps to throw away at the start of the sampling
-                before returning the results.
-      - step: Only every step-th sample will be returned.
+                before returning the results. Defaults to 0.7 * N^2, where
+                N is n_variables or the number of free variables of the model.
+      - step: Only every step-th sample will be returned. Defaults to
+              0.1 * N + 3.
+      - method: Either 'site' to update the variables one by one, 'block'
+                to colour the interaction graph and update every colour class
+                at once, since its variables are conditionally independent,
+                or 'cluster' to perform Swendsen-Wang cluster flips, or
+                'multispin' to update 64 chains per machine word on a grid
+                lattice, see MultispinLattice.
+      - n_jobs: Number of worker processes running independent chains, with
+                the joblib semantics (-1 uses all the cores).
+      - seed: Seed of the random number generator, or a numpy Generator.
+              Parallel workers receive independent child streams of it.
+      - adaptive: End the burn-in as soon as the split R-hat of the energy
+                  traces of the chains falls below target_rhat, burnin
+                  becoming only an upper bound, and unless step is given,
+                  thin by the measured autocorrelation time. The diagnostics
+                  of the run are exposed on the returned pool.
+      - quantum: Spacing of the grid of the model coefficients. The local
+                 fields are then integer multiples of it, and the conditional
+                 probabilities are looked up in a precomputed table instead
+                 of evaluating exponentials. Detected automatically if None,
+                 False disables the lookup.
+      - lattice: The GridBuilder which generated the model, required by the
+                 'multispin' method.
+      - jit: Run the 'site' sweeps through the kernels compiled by numba,
+             when it is installed. The samples are the same as without it.
+      - checkpoint_interval: Seconds between two checkpoints of a run given
+                             a checkpoint file.
+      - moments: Accumulate the magnetizations and the correlations of the
+                 edges over the recorded samples, returned as the SpinMoments
+                 of the pool.
     """
 
-    def __init__(self, burnin=None, step=None, n_variables=None):
-        self.burnin = burnin or int(0.7 * n_variables ** 2)
-        self.step = step or int(0.1 * n_variables) + 3
+    METHODS = ('site', 'block', 'cluster', 'multispin')
+
+    # Largest number of entries in a lookup table of conditional probabilities
+    MAX_TABLE = 2 ** 20
+
+    def __init__(self, burnin=None, step=None, n_variables=None, method='site',
+                 n_jobs=1, seed=None, adaptive=False, target_rhat=1.01,
+                 quantum=None, lattice=None, jit=True, checkpoint_interval=600,
+                 moments=False):
+        if method not in self.METHODS:
+            raise ValueError("Unknown sampling method: {}".format(method))
+
+        if method == 'multispin' and lattice is None:
+            raise ValueError("The multispin method requires the lattice of the model")
+
+        self.burnin = burnin
+        self.step = step
+        self.n_variables = n_variables
+        self.method = method
+        self.n_jobs = n_jobs
+        self.rng = numpy.random.default_rng(seed)
+        self.adaptive = adaptive
+        self.target_rhat = target_rhat
+        self.quantum = quantum
+        self.lattice = lattice
+        self.jit = jit
+        self.checkpoint_interval = checkpoint_interval
+        self.moments = moments
+
+        # Last lookup table built, reused while the quantum, the bound of the
+        # fields and the temperatures stay the same
+        self._table = None
+
+    def schedule(self, compiled):
+        """
+        Returns the burn-in and the thinning step used for the given model.
+        """
+
+        n_variables = self.n_variables or len(compiled)
+
+        burnin = self.burnin or int(0.7 * n_variables ** 2)
+        step = self.step or int(0.1 * n_variables) + 3
+
+        return burnin, step
+
+    def neighbourhood(self, compiled):
+        """
+        Builds a list of (neighbour, coupling) pairs for every variable index
+        of the compiled model, so that local fields can be computed in
+        O(degree) without touching NumPy scalars in the hot loop.
+        """
+
+        indptr = compiled.indptr.tolist()
+        indices = compiled.indices.tolist()
+        couplings = compiled.couplings.tolist()
+
+        return [
+            list(zip(indices[start:end], couplings[start:end]))
+            for start, end in zip(indptr[:-1], indptr[1:])
+        ]
+
+    @staticmethod
+    def conditional(field, temperature, value=-1):
+        """
+        Computes the probability of a variable obtaining the value given the
+        local field acting on it.
+        """
+
+        # All the energy terms not containing the variable cancel out, hence
+        # P(s_i = value) = exp(-value * f / T) / (exp(-f / T) + exp(f / T))
+        exponent = 2 * value * field / float(temperature)
+
+        # Avoid overflow for strongly biased variables
+        if exponent > 700:
+            return 0.0
+
+        return 1.0 / (1.0 + math.exp(exponent))
 
     def node_probability(self, model, assignment, variable, temperature, value=-1):
         """
@@ -31,57 +142,834 @@ class GibbsSampler(IsingSampler):
         rest of the assignment.
         """
 
-        possible_samples = []
-        for v in (-1, 1):
-            z_assignment = assignment.copy()
-            z_assignment[variable] = v
-            possible_samples.append(IsingSample(model, z_assignment))
+        compiled = model.compile()
+        indices, couplings = compiled.neighbours(compiled.index[variable])
 
-        i_assignment = assignment.copy()
-        i_assignment[variable] = value
-        i_sample = IsingSample(model, i_assignment)
-
-        nominator = math.exp(-1 * i_sample.energy / float(temperature))
-        denominator = sum([
-            math.exp(-1 * sample.energy / float(temperature))
-            for sample in possible_samples
+        field = compiled.h[compiled.index[variable]] + sum([
+            coupling * assignment[compiled.variables[neighbour]]
+            for neighbour, coupling in zip(indices, couplings)
         ])
 
-        return nominator / denominator
+        return self.conditional(field, temperature, value)
+
+    @staticmethod
+    def conditionals(fields, temperature):
+        """
+        Computes the probabilities of obtaining -1 given an array of local
+        fields, see conditional().
+        """
+
+        exponent = numpy.clip(-2 * fields / temperature, -700, 700)
+        return 1.0 / (1.0 + numpy.exp(exponent))
+
+    def lookup_table(self, compiled, temperature, n_chains=1):
+        """
+        For quantized models, returns the model with integer coefficients,
+        the largest magnitude of an integerized local field, a table of
+        the probabilities of obtaining -1 indexed by the integerized local
+        field shifted by that magnitude, with one row per distinct
+        temperature, and the row of the table read by every chain.
+
+        Returns None if the model is not quantized or the table would be too
+        large. The last table is kept and reused by models which only differ
+        in their coefficients.
+        """
+
+        if self.quantum is False:
+            return None
+
+        quantum = self.quantum or compiled.quantum()
+        if quantum is None:
+            return None
+
+        quantized = compiled.quantized(quantum)
+
+        bound = int(numpy.max(
+            numpy.abs(quantized.h) + quantized.row_sums(
+                numpy.ones(len(quantized), dtype=numpy.int64), quantized.indptr,
+                quantized.indices, numpy.abs(quantized.couplings)
+            ),
+            initial=0
+        ))
+
+        # Chains sharing a temperature share its row
+        temperatures, rows = numpy.unique(
+            numpy.asarray(temperature, dtype=float).reshape(-1), return_inverse=True
+        )
+
+        if len(temperatures) * (2 * bound + 1) > self.MAX_TABLE:
+            return None
+
+        key = (quantum, bound, temperatures.tobytes())
+
+        if self._table is None or self._table[0] != key:
+            fields = numpy.arange(-bound, bound + 1) * quantum
+            self._table = (key, self.conditionals(fields, temperatures[:, None]))
+
+        table = self._table[1]
+        rows = numpy.ascontiguousarray(
+            numpy.broadcast_to(rows.reshape(-1).astype(numpy.intp), (n_chains,))
+        )
+
+        return quantized, bound, table, rows
+
+    def site_sweeper(self, compiled, temperature, n_chains=1, rng=None):
+        """
+        Returns a function which updates a (chains, variables) array of spins
+        in place, one variable at a time. The temperature may also be given
+        as a vector, one per chain.
+
+        Every sweep draws a (chains, variables) block of uniforms, and
+        a variable obtains -1 if its uniform does not exceed the conditional
+        probability of -1.
+        """
+
+        if self.jit and kernels.numba is not None:
+            return self.kernel_sweeper(compiled, temperature, n_chains, rng)
+
+        rng = rng or self.rng
+        lookup = self.lookup_table(compiled, temperature, n_chains)
+
+        if lookup is not None:
+            compiled, bound, table, table_rows = lookup
+
+        biases = compiled.h.tolist()
+        neighbours = self.neighbourhood(compiled)
+        conditional = self.conditional
+
+        # Chains may run at different temperatures
+        scale = numpy.asarray(temperature, dtype=float).reshape(-1)
+        chain_temperature = float(scale[0])
+
+        def sweep(spins):
+            # A single chain is fastest with plain Python numbers
+            values = spins[0].tolist()
+            draws = rng.random((1, len(biases)))[0].tolist()
+
+            for index, bias in enumerate(biases):
+                field = bias + sum([
+                    coupling * values[neighbour]
+                    for neighbour, coupling in neighbours[index]
+                ])
+                probability = conditional(field, chain_temperature)
+                values[index] = -1 if draws[index] <= probability else 1
+
+            spins[0] = values
+
+        def sweep_lookup(spins):
+            # Same as sweep, with integer fields indexing the lookup table
+            values = spins[0].tolist()
+            draws = rng.random((1, len(biases)))[0].tolist()
+            probabilities = table[table_rows[0]].tolist()
+
+            for index, bias in enumerate(biases):
+                field = bias + sum([
+                    coupling * values[neighbour]
+                    for neighbour, coupling in neighbours[index]
+                ])
+                probability = probabilities[field + bound]
+                values[index] = -1 if draws[index] <= probability else 1
+
+            spins[0] = values
+
+        def sweep_chains(spins):
+            draws = rng.random(spins.shape)
+
+            # Update the variable in all the chains at once
+            for index, bias in enumerate(biases):
+                indices, couplings = compiled.neighbours(index)
+                fields = bias + spins[:, indices].dot(couplings)
+
+                if lookup is not None:
+                    probabilities = table[table_rows, fields + bound]
+                else:
+                    probabilities = self.conditionals(fields, scale)
+
+                spins[:, index] = numpy.where(draws[:, index] <= probabilities, -1, 1)
+
+        if lookup is not None and n_chains == 1:
+            return sweep_lookup
+
+        return sweep if n_chains == 1 else sweep_chains
+
+    def kernel_sweeper(self, compiled, temperature, n_chains=1, rng=None):
+        """
+        Returns a function performing the same updates as site_sweeper(),
+        from the same draws, through the loops of the kernels module.
+        """
+
+        rng = rng or self.rng
+        lookup = self.lookup_table(compiled, temperature, n_chains)
+
+        if lookup is not None:
+            quantized, bound, table, rows = lookup
+
+            arrays = (quantized.h, quantized.indptr, quantized.indices, quantized.couplings)
+            arguments = (table, rows, bound)
+            kernel = kernels.site_sweep_lookup
+        else:
+            temperatures = numpy.broadcast_to(
+                numpy.asarray(temperature, dtype=float).reshape(-1), (n_chains,)
+            )
+
+            arrays = (compiled.h, compiled.indptr, compiled.indices, compiled.couplings)
+            arguments = (numpy.ascontiguousarray(temperatures),)
+            kernel = kernels.site_sweep
+
+        def sweep(spins):
+            draws = rng.random(spins.shape)
+            kernel(spins, draws, *(arrays + arguments))
+
+        return sweep
+
+    def block_sweeper(self, compiled, temperature, n_chains=1, rng=None):
+        """
+        Returns a function which updates a (chains, variables) array of spins
+        in place, one colour class at a time. The temperature may also be
+        given as a vector, one per chain.
+        """
+
+        rng = rng or self.rng
+        lookup = self.lookup_table(compiled, temperature, n_chains)
+
+        if lookup is not None:
+            coefficients, bound, table, table_rows = lookup
+
+            # Every chain reads the table row of its temperature
+            table_rows = table_rows[:, None]
+        else:
+            coefficients = compiled
+
+        blocks = [
+            (rows, coefficients.h[rows], coefficients.adjacency(rows))
+            for rows in compiled.colour_classes()
+        ]
+
+        # Chains may run at different temperatures
+        scale = numpy.asarray(temperature, dtype=float).reshape(-1, 1)
+
+        def sweep(spins):
+            draws = rng.random(spins.shape)
 
-    def sample(self, model, num_samples, temperature=1):
+            for rows, biases, adjacency in blocks:
+                fields = biases + compiled.row_sums(spins, *adjacency)
+
+                if lookup is not None:
+                    indices = fields.astype(numpy.intp) + bound
+                    probabilities = table[table_rows, indices]
+                else:
+                    probabilities = self.conditionals(fields, scale)
+
+                spins[:, rows] = numpy.where(draws[:, rows] <= probabilities, -1, 1)
+
+        return sweep
+
+    def cluster_sweeper(self, compiled, temperature, n_chains=1, rng=None):
+        """
+        Returns a function which performs a Swendsen-Wang update of
+        a (chains, variables) array of spins in place. The temperature may
+        also be given as a vector, one per chain.
+
+        Every satisfied coupling becomes a bond with probability
+        1 - exp(-2 |J_ij| / T), and every cluster of bonded variables is then
+        flipped as a whole with its heat bath probability given the biases.
+        """
+
+        rng = rng or self.rng
+        node1, node2 = compiled.edges[:, 0], compiled.edges[:, 1]
+        temperatures = numpy.broadcast_to(
+            numpy.asarray(temperature, dtype=float).reshape(-1), (n_chains,)
+        )
+
+        bond_probabilities = -numpy.expm1(
+            -2 * numpy.abs(compiled.edge_couplings) / temperatures[:, None]
+        )
+
+        def sweep(spins):
+            satisfied = compiled.edge_couplings * spins[:, node1] * spins[:, node2] < 0
+            bonds = satisfied & (rng.random(satisfied.shape) < bond_probabilities)
+            draws = rng.random(spins.shape)
+
+            for chain, active, chain_draws, chain_temperature in \
+                    zip(spins, bonds, draws, temperatures):
+                roots = compiled.connected_components(active)
+
+                # Energy of the biases within each cluster, the bonds do not
+                # change their energy when the cluster is flipped as a whole
+                energies = numpy.bincount(
+                    roots, weights=compiled.h * chain, minlength=len(compiled)
+                )
+                flips = self.conditionals(energies, chain_temperature)
+                flipped = chain_draws < flips
+
+                chain[flipped[roots]] *= -1
+
+        return sweep
+
+    def sample(self, model, num_samples, temperature=1, n_chains=1, initial=None,
+               burnin=None, checkpoint=None):
         """
         Updates each variable using its connditional probability distribution,
         and yields the result.
+
+        With n_chains > 1, the given number of independent chains are advanced
+        together as rows of a single spin matrix, paying the burn-in once for
+        all of them, and their samples are collected in a single pool.
+
+        With n_jobs other than 1, the samples are split among worker processes
+        each running its own n_chains chains.
+
+        The chains start from uniformly random states unless initial states
+        are given, see starting_states(). Chains started close to equilibrium
+        need a shorter burn-in, which then overrides the schedule.
+
+        If a checkpoint file is given, the state of the run is saved in it
+        every checkpoint_interval seconds and at its end, see resume().
         """
 
-        # Keep track of the iteration number for thinning and burn-in
-        iteration = 0
+        states = None
+        if initial is not None:
+            states = self.starting_states(model.compile(), initial, n_chains)
 
-        # Collect samples
+        if self.n_jobs != 1:
+            if checkpoint is not None:
+                raise ValueError("Checkpoints are only supported within a single process")
+
+            return self.sample_parallel(
+                model, num_samples, temperature, n_chains, states, burnin
+            )
+
+        spins = None
+        if states is not None:
+            spins = self.initial_state(model.compile(), n_chains, states=states)
+
+        return self.run_chains(
+            model, num_samples, temperature, n_chains, spins=spins, burnin=burnin,
+            checkpoint=checkpoint
+        )
+
+    def resume(self, model, checkpoint):
+        """
+        Continues the run saved in the checkpoint file, as if it had not been
+        interrupted, and returns its pool. The sampler needs to be configured
+        as the one which started the run.
+        """
+
+        resumed = self.load_checkpoint(model, checkpoint)
+
+        if len(resumed['pool']) >= resumed['num_samples']:
+            return resumed['pool']
+
+        return self.run_chains(
+            model, resumed['num_samples'], resumed['temperature'], resumed['n_chains'],
+            rng=resumed['rng'], checkpoint=checkpoint, resumed=resumed
+        )
+
+    def save_checkpoint(self, checkpoint, compiled, spins, rng, temperature, n_chains,
+                        num_samples, schedule, pool, trace):
+        """
+        Saves the state of a run to the checkpoint file: the number of
+        variables of the compiled model, the spins of the chains, the state
+        of their random generator, the schedule and the position in it, and
+        the samples collected so far. The file is
+        replaced atomically, so an interruption leaves the previous
+        checkpoint intact.
+        """
+
+        packed = isinstance(spins, PackedSpins)
+
+        arrays = {
+            'n_variables': len(compiled),
+            'spins': spins.words if packed else spins,
+            'packed_chains': spins.n_chains if packed else 0,
+            'rng': json.dumps(rng.bit_generator.state),
+            'temperature': temperature,
+            'n_chains': n_chains,
+            'num_samples': num_samples,
+            'burnin': schedule['burnin'],
+            'step': schedule['step'],
+            'iteration': schedule['iteration'],
+            'diagnostics': json.dumps(pool.diagnostics),
+            'trace': numpy.array(trace, dtype=float),
+        }
+
+        # The pool is stored in its packed wire format
+        arrays.update({'pool_' + key: value for key, value in pool.to_wire().items()})
+
+        if pool.moments is not None:
+            arrays.update({
+                'moment_count': pool.moments.count,
+                'moment_spins': pool.moments.spin_sums,
+                'moment_pairs': pool.moments.pair_sums,
+            })
+
+        temporary = checkpoint + '.tmp'
+        with open(temporary, 'wb') as f:
+            numpy.savez_compressed(f, **arrays)
+
+        os.replace(temporary, checkpoint)
+
+    def load_checkpoint(self, model, checkpoint):
+        """
+        Loads the state of a run saved by save_checkpoint().
+        """
+
+        compiled = model.compile()
+
+        with numpy.load(checkpoint) as data:
+            arrays = {key: data[key] for key in data.files}
+
+        if int(arrays['n_variables']) != len(compiled):
+            raise ValueError("Checkpoint does not match the {} variables of the model"
+                             .format(len(compiled)))
+
+        state = json.loads(str(arrays['rng']))
+        rng = numpy.random.Generator(getattr(numpy.random, state['bit_generator'])())
+        rng.bit_generator.state = state
+
+        spins = arrays['spins']
+        if arrays['packed_chains']:
+            spins = PackedSpins(spins, int(arrays['packed_chains']))
+
+        temperature = arrays['temperature']
+        pool = SamplePool.from_wire(model, {
+            key[len('pool_'):]: value for key, value in arrays.items() if key.startswith('pool_')
+        })
+        pool.diagnostics.update(json.loads(str(arrays['diagnostics'])))
+
+        temperature = temperature.tolist() if temperature.ndim else float(temperature)
+
+        if 'moment_count' in arrays:
+            pool.moments = SpinMoments(compiled, temperature)
+            pool.moments.count = int(arrays['moment_count'])
+            pool.moments.spin_sums = arrays['moment_spins']
+            pool.moments.pair_sums = arrays['moment_pairs']
+
+        return {
+            'spins': spins,
+            'rng': rng,
+            'temperature': temperature,
+            'n_chains': int(arrays['n_chains']),
+            'num_samples': int(arrays['num_samples']),
+            'burnin': int(arrays['burnin']),
+            'step': int(arrays['step']),
+            'iteration': int(arrays['iteration']),
+            'pool': pool,
+            'trace': list(arrays['trace']),
+        }
+
+    def starting_states(self, compiled, initial, n_chains):
+        """
+        Returns the (chains, variables) int8 matrix of the initial states of
+        the chains, given as a SamplePool, whose best samples are used, an
+        IsingSample or an assignment, a sequence of these, or a matrix over
+        the compiled variables. The states are repeated if there are fewer
+        of them than chains.
+        """
+
+        if isinstance(initial, SamplePool):
+            initial = initial.n_best(n_chains)
+        elif isinstance(initial, (IsingSample, dict)):
+            initial = [initial]
+
+        initial = list(initial)
+
+        if all(isinstance(state, (IsingSample, dict)) for state in initial):
+            states = numpy.array([
+                compiled.to_state(getattr(state, 'assignment', state))
+                for state in initial
+            ]).reshape(-1, len(compiled))
+        else:
+            states = numpy.atleast_2d(numpy.asarray(initial))
+
+        if not len(states) or states.shape[1] != len(compiled):
+            raise ValueError("Initial states do not match the {} variables of the model"
+                             .format(len(compiled)))
+
+        return states[numpy.arange(n_chains) % len(states)].astype(numpy.int8)
+
+    def sample_temperatures(self, model, temperatures, num_samples, n_chains=1,
+                            burnin=None):
+        """
+        Samples the model at every given temperature with the same chains,
+        annealed from the highest temperature to the lowest one. The chains
+        are burned in once, and at every following temperature they start
+        from their previous state, needing only burnin sweeps to adapt,
+        by default ten thinning steps.
+
+        Returns a dict of SamplePools keyed by temperature. The chains run in
+        the current process regardless of n_jobs.
+        """
+
+        compiled = model.compile()
+        step = self.schedule(compiled)[1]
+        burnin = 10 * step if burnin is None else burnin
+
+        spins = self.initial_state(compiled, n_chains)
+        pools = dict()
+
+        for position, temperature in enumerate(sorted(temperatures, reverse=True)):
+            pools[temperature] = self.run_chains(
+                model, num_samples, temperature, n_chains,
+                spins=spins, burnin=burnin if position else None
+            )
+
+        return pools
+
+    def sample_parallel(self, model, num_samples, temperature=1, n_chains=1,
+                        states=None, burnin=None):
+        """
+        Runs independent chains in a pool of worker processes and merges their
+        partial results into a single SamplePool.
+        """
+
+        if not num_samples:
+            return SamplePool()
+
+        n_jobs = min(effective_n_jobs(self.n_jobs), num_samples)
+
+        # Split the samples as evenly as possible among the workers
+        shares = [
+            num_samples // n_jobs + (1 if worker < num_samples % n_jobs else 0)
+            for worker in range(n_jobs)
+        ]
+
+        # Every worker gets its own independent child stream
+        streams = self.rng.spawn(n_jobs)
+
+        partials = Parallel(n_jobs=n_jobs)(
+            delayed(self.sample_partial)(
+                model, share, temperature, n_chains, stream, states, burnin
+            )
+            for share, stream in zip(shares, streams)
+        )
+
+        return self.merge_partials(model, temperature, partials)
+
+    def sample_partial(self, model, num_samples, temperature, n_chains, rng,
+                       states=None, burnin=None):
+        """
+        Runs the chains in a worker process, drawing from the given random
+        generator, and returns the pool in the format of SamplePool.to_wire()
+        together with the accumulated SpinMoments if any, the diagnostics of
+        the pool and the statistics of the run, see run_chains().
+        """
+
+        compiled = model.compile()
+
+        spins = None
+        if states is not None:
+            spins = self.initial_state(compiled, n_chains, rng, states)
+
+        statistics = dict()
+        pool = self.run_chains(
+            model, num_samples, temperature, n_chains, rng, spins, burnin,
+            statistics=statistics
+        )
+
+        return pool.to_wire(), pool.moments, pool.diagnostics, statistics
+
+    def merge_partials(self, model, temperature, partials):
+        """
+        Merges the results of sample_partial() into a single SamplePool. The
+        convergence diagnostics are computed again over the energy traces of
+        the chains of all the workers, and the burn-in, thinning and burn-in
+        R-hat reported are the largest ones among the workers.
+        """
+
+        # Workers return their pools in the wire format, which carries
+        # neither the model nor the samples as objects
         pool = SamplePool()
+        traces = []
 
-        # Create initial assignment
-        assignment = {
-            key: -1 if random.random() < 0.5 else 1
-            for key in model.variables
+        for wire, moments, diagnostics, statistics in partials:
+            pool.merge_wire(model, wire)
+
+            if moments is not None:
+                if pool.moments is None:
+                    pool.moments = moments
+                else:
+                    pool.moments.update(moments)
+
+            for key in ('burnin', 'burnin_rhat', 'step'):
+                if key in diagnostics:
+                    pool.diagnostics[key] = max(pool.diagnostics.get(key, diagnostics[key]),
+                                                diagnostics[key])
+
+            if 'trace' in statistics:
+                traces.append(statistics['trace'])
+
+        if traces:
+            pool.diagnostics.update(self.trace_diagnostics(traces))
+
+        return pool
+
+    def trace_diagnostics(self, traces):
+        """
+        Returns the convergence diagnostics of the energy traces of the
+        recorded samples, given as a list of (chains, sweeps) arrays of
+        separate runs. R-hat and the autocorrelation time are computed over
+        the chains of all the runs cut to the shortest one, while the
+        effective sample size counts every recorded sample.
+        """
+
+        length = min(trace.shape[1] for trace in traces)
+        chains = numpy.concatenate([trace[:, :length] for trace in traces])
+        tau = autocorrelation_time(chains)
+
+        return {
+            'rhat': split_rhat(chains),
+            'autocorrelation_time': tau,
+            'effective_sample_size': sum(trace.size for trace in traces) / tau,
         }
 
-        progress = tqdm.tqdm(total=self.burnin + num_samples * self.step)
-        while len(pool) < num_samples:
+    def multispin_lattice(self, compiled):
+        """
+        Returns the multi-spin coded engine of the lattice model.
+        """
+
+        return MultispinLattice(compiled, self.lattice.width, self.lattice.height)
+
+    def initial_state(self, compiled, n_chains, rng=None, states=None):
+        """
+        Returns a (chains, variables) matrix of uniformly random spins, or
+        their PackedSpins for the 'multispin' method. If a (chains, variables)
+        matrix of states is given, the chains start from a copy of it instead.
+        """
+
+        rng = rng or self.rng
+
+        if states is not None:
+            if self.method == 'multispin':
+                return PackedSpins.pack(states)
+
+            return numpy.array(states, dtype=numpy.int8)
+
+        if self.method == 'multispin':
+            return self.multispin_lattice(compiled).initial_state(n_chains, rng)
+
+        return numpy.where(
+            rng.random((n_chains, len(compiled))) < 0.5, -1, 1
+        ).astype(numpy.int8)
+
+    def sweeper(self, compiled, temperature, n_chains, rng=None, iteration=0):
+        """
+        Returns a function which advances all the chains by a single sweep.
+        The chains continue a run which already performed the given number
+        of sweeps, which only matters to samplers whose updates depend on it.
+        """
+
+        if self.method == 'block':
+            return self.block_sweeper(compiled, temperature, n_chains, rng)
+        elif self.method == 'cluster':
+            return self.cluster_sweeper(compiled, temperature, n_chains, rng)
+        elif self.method == 'multispin':
+            return self.multispin_lattice(compiled).sweeper(temperature, rng or self.rng)
+        else:
+            return self.site_sweeper(compiled, temperature, n_chains, rng)
+
+    def observed(self, spins):
+        """
+        Returns the rows of the spin matrix which are recorded as samples.
+        """
+
+        if self.method == 'multispin':
+            return spins.unpack()
+
+        return spins
+
+    def adaptive_burnin(self, compiled, spins, sweep, max_burnin):
+        """
+        Sweeps the chains until the split R-hat of their energy traces, taken
+        over the second half of the burn-in, falls below the target.
+
+        Returns the number of sweeps performed, the thinning step and the
+        final R-hat.
+        """
+
+        trace = []
+        iteration = 0
+        next_check = 20
+
+        while iteration < max_burnin:
+            iteration += 1
+            sweep(spins)
+            trace.append(compiled.energy(self.observed(spins)))
+
+            if iteration >= next_check:
+                if split_rhat(numpy.transpose(trace[len(trace) // 2:])) < self.target_rhat:
+                    break
+
+                # Check ever less frequently to keep the overhead linear
+                next_check = iteration + max(10, iteration // 10)
+
+        warm = numpy.transpose(trace[len(trace) // 2:])
+        rhat = split_rhat(warm)
+
+        if self.step:
+            step = self.step
+        else:
+            step = max(1, int(math.ceil(autocorrelation_time(warm))))
+
+        self.debug("Burn-in ended after {} sweeps, R-hat {:.4f}, step {}"
+                   .format(iteration, rhat, step))
+
+        return iteration, step, rhat
+
+    def sample_iter(self, model, temperature=1, n_chains=1, raw=False,
+                    diagnostics=None, rng=None, spins=None, burnin=None,
+                    step=None, iteration=0):
+        """
+        Runs the chains indefinitely, lazily yielding the thinned samples
+        after the burn-in: an IsingSample per chain, or with raw=True the
+        (chains, variables) int8 matrix of the recorded chains over the
+        compiled variables, in a single copy per thinned sweep.
+
+        If a diagnostics dict is given, the burn-in and thinning used are
+        recorded in it. The chains draw from the sampler's random generator
+        unless another one is given.
+
+        If spins are given, as returned by initial_state(), the chains
+        continue from them and keep updating them in place, and the burn-in
+        and thinning of the schedule may be overridden. Chains resumed at
+        a later iteration skip the adaptive burn-in, and the iteration of the
+        last recorded sweep is kept in the diagnostics.
+        """
+
+        # Work with integer indices over the compiled model, the neighbourhoods
+        # do not change during sampling
+        compiled = model.compile()
+        default_burnin, default_step = self.schedule(compiled)
+        burnin = default_burnin if burnin is None else burnin
+        step = step or default_step
+
+        # Create initial assignment
+        if spins is None:
+            spins = self.initial_state(compiled, n_chains, rng)
+
+        sweep = self.sweeper(compiled, temperature, n_chains, rng, iteration)
+
+        # Chains started close to equilibrium may skip the burn-in entirely
+        if self.adaptive and not iteration and burnin:
+            iteration, step, rhat = self.adaptive_burnin(compiled, spins, sweep, burnin)
+            burnin = iteration
+
+            if diagnostics is not None:
+                diagnostics['burnin_rhat'] = rhat
+
+        if diagnostics is not None:
+            diagnostics.update({'burnin': burnin, 'step': step})
+
+        while True:
             iteration += 1
 
-            for variable in model.variables:
-                probability = self.node_probability(model, assignment, variable, temperature)
-                sampled_value = -1 if random.random() <= probability else 1
-                assignment[variable] = sampled_value
+            sweep(spins)
 
             # Skip first 1000 iterations for burn-in, return every 100th iteration
             # since subsequent samples are correlated
-            if iteration >= self.burnin and iteration % self.step == 0:
-                sample = IsingSample(model, assignment.copy())
-                pool.add(sample)
+            if iteration >= burnin and iteration % step == 0:
+                observed = self.observed(spins).copy()
+
+                if diagnostics is not None:
+                    diagnostics['iteration'] = iteration
+
+                if raw:
+                    yield observed
+                else:
+                    for chain in observed:
+                        yield IsingSample.from_state(model, chain)
+
+    def run_chains(self, model, num_samples, temperature=1, n_chains=1, rng=None,
+                   spins=None, burnin=None, checkpoint=None, resumed=None,
+                   statistics=None):
+        """
+        Runs the chains in the current process and collects their samples,
+        see sample_iter() for the optional arguments. The run is saved to the
+        checkpoint file if given, and continues the resumed state loaded by
+        load_checkpoint() if given.
+
+        If a statistics dict is given, the raw statistics needed to combine
+        the diagnostics of the run with other runs are stored in it: the
+        (chains, sweeps) energy trace of the recorded samples in the adaptive
+        mode.
+        """
+
+        # Collect samples
+        pool = SamplePool()
+        compiled = model.compile()
+        rng = rng or self.rng
+
+        # Energy traces of the recorded samples
+        trace = []
+
+        # Schedule and position of the chains
+        schedule = dict()
+        step = None
+        iteration = 0
+
+        if resumed is not None:
+            pool, trace = resumed['pool'], resumed['trace']
+            spins, burnin, step = resumed['spins'], resumed['burnin'], resumed['step']
+            iteration = resumed['iteration']
+
+        if spins is None:
+            spins = self.initial_state(compiled, n_chains, rng)
+
+        if self.moments and pool.moments is None:
+            pool.moments = SpinMoments(compiled, temperature)
+
+        # Nothing to sample, the chains are not even burned in
+        if len(pool) >= num_samples:
+            return pool
+
+        progress = tqdm.tqdm(total=num_samples, initial=len(pool))
+        states = self.sample_iter(
+            model, temperature, n_chains, raw=True, diagnostics=schedule,
+            rng=rng, spins=spins, burnin=burnin, step=step, iteration=iteration
+        )
+
+        saved = time.monotonic()
+
+        for observed in states:
+            if self.adaptive:
+                trace.append(compiled.energy(observed))
+
+            recorded = observed[:num_samples - len(pool)]
+
+            if pool.moments is not None:
+                pool.moments.add(recorded)
+
+            pool.add_states(model, recorded)
+            progress.update(len(recorded))
+
+            if self.adaptive:
+                for key in ('burnin', 'burnin_rhat', 'step'):
+                    if key in schedule:
+                        pool.diagnostics[key] = schedule[key]
+
+            finished = len(pool) >= num_samples
+
+            if checkpoint is not None and \
+                    (finished or time.monotonic() - saved >= self.checkpoint_interval):
+                # The spins of the suspended generator are those of the
+                # recorded sweep, and no draws were made since
+                self.save_checkpoint(
+                    checkpoint, compiled, spins, rng, temperature, n_chains,
+                    num_samples, schedule, pool, trace
+                )
+                saved = time.monotonic()
+
+            if finished:
+                break
+
+        states.close()
+        progress.close()
+
+        if self.adaptive:
+            trace = numpy.reshape(numpy.asarray(trace, dtype=float), (-1, n_chains)).T
+            pool.diagnostics.update(self.trace_diagnostics([trace]))
 
-            progress.update(1)
+            if statistics is not None:
+                statistics['trace'] = trace
 
         return pool
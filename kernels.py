@@ -0,0 +1,65 @@
+"""
+Sweep kernels of GibbsSampler over the CSR arrays of CompiledIsingModel,
+written as plain loops so that numba can compile them when it is installed.
+Without numba the samplers keep using their NumPy implementations, which
+are much faster than these loops interpreted.
+"""
+
+import math
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def site_sweep(spins, draws, h, indptr, indices, couplings, temperatures):
+    """
+    Updates the (chains, variables) spins in place one variable at a time,
+    every chain at its temperature. A variable obtains -1 if its uniform in
+    the (chains, variables) draws does not exceed the conditional
+    probability of -1.
+    """
+
+    n_chains, n_variables = spins.shape
+
+    for chain in range(n_chains):
+        for index in range(n_variables):
+            field = h[index]
+            for position in range(indptr[index], indptr[index + 1]):
+                field += couplings[position] * spins[chain, indices[position]]
+
+            # Same as GibbsSampler.conditional() for the value -1
+            exponent = -2 * field / temperatures[chain]
+            if exponent > 700:
+                probability = 0.0
+            else:
+                probability = 1.0 / (1.0 + math.exp(exponent))
+
+            spins[chain, index] = -1 if draws[chain, index] <= probability else 1
+
+
+def site_sweep_lookup(spins, draws, h, indptr, indices, couplings, table, rows, bound):
+    """
+    Same as site_sweep for integer coefficients, looking the probabilities
+    up in the row of the table given for every chain, see
+    GibbsSampler.lookup_table().
+    """
+
+    n_chains, n_variables = spins.shape
+
+    for chain in range(n_chains):
+        probabilities = table[rows[chain]]
+
+        for index in range(n_variables):
+            field = h[index]
+            for position in range(indptr[index], indptr[index + 1]):
+                field += couplings[position] * spins[chain, indices[position]]
+
+            probability = probabilities[field + bound]
+            spins[chain, index] = -1 if draws[chain, index] <= probability else 1
+
+
+if numba is not None:
+    site_sweep = numba.njit(cache=True, nogil=True)(site_sweep)
+    site_sweep_lookup = numba.njit(cache=True, nogil=True)(site_sweep_lookup)
@@ -0,0 +1,118 @@
+import numpy
+
+from data import SamplePool
+from gibbs import GibbsSampler
+from logger import LoggerMixin
+
+
+class ContrastiveDivergence(LoggerMixin):
+    """
+    Fits the biases and couplings of an IsingModel to data by persistent
+    contrastive divergence, treating the model as a Boltzmann machine with
+    P(s) proportional to exp(-E(s) / T).
+
+    The gradient of the log-likelihood compares the moments <s_i> and
+    <s_i s_j> of the data with those of the model, which are estimated from
+    chains that persist across the updates: after every update they are
+    advanced by a few sweeps from where they were, instead of being burned
+    in again.
+
+    Takes:
+      - sampler: The GibbsSampler advancing the chains, block updates by
+                 default.
+      - n_chains: Number of persistent chains.
+      - n_sweeps: Number of sweeps of the chains between two updates.
+      - learning_rate: Step size of the gradient ascent.
+      - temperature: Temperature of the model.
+    """
+
+    def __init__(self, sampler=None, n_chains=100, n_sweeps=1, learning_rate=0.01,
+                 temperature=1):
+        self.sampler = sampler or GibbsSampler(method='block')
+        self.n_chains = n_chains
+        self.n_sweeps = n_sweeps
+        self.learning_rate = learning_rate
+        self.temperature = temperature
+
+        # State of the persistent chains and the model they belong to
+        self.spins = None
+        self.model = None
+
+    def moments(self, compiled, states, weights=None):
+        """
+        Returns the weighted means of the spins and of the products of the
+        spins joined by every edge, over the rows of the states.
+        """
+
+        states = numpy.asarray(states, dtype=float)
+        pairs = states[:, compiled.edges[:, 0]] * states[:, compiled.edges[:, 1]]
+
+        return (
+            numpy.average(states, axis=0, weights=weights),
+            numpy.average(pairs, axis=0, weights=weights),
+        )
+
+    def data_moments(self, compiled, data):
+        """
+        Returns the moments of the data, given either as a SamplePool or as
+        a sequence of assignments of the model variables.
+        """
+
+        if isinstance(data, SamplePool):
+            states, weights = data.as_arrays(compiled)
+        else:
+            states = [compiled.to_state(assignment) for assignment in data]
+            weights = None
+
+        return self.moments(compiled, numpy.reshape(states, (-1, len(compiled))), weights)
+
+    def fit(self, model, data, n_iterations=1000):
+        """
+        Updates the coefficients of the model in place, performing the given
+        number of gradient steps, and returns it. The chains persist across
+        calls for the same model, so that training can be resumed.
+
+        The steps only advance the compiled form of the model, whose
+        coefficients are written back to the model once the fit ends.
+        """
+
+        if model.clamped:
+            raise ValueError("Cannot fit the coefficients of a clamped model")
+
+        compiled = model.compile()
+        data_spins, data_pairs = self.data_moments(compiled, data)
+
+        if self.model is not model:
+            self.model = model
+            self.spins = self.sampler.initial_state(compiled, self.n_chains)
+
+        h = compiled.h.copy()
+        couplings = compiled.edge_couplings.copy()
+        rate = self.learning_rate / float(self.temperature)
+
+        try:
+            for iteration in range(n_iterations):
+                # The chains continue under the updated coefficients
+                sweep = self.sampler.sweeper(compiled, self.temperature, self.n_chains)
+                for _ in range(self.n_sweeps):
+                    sweep(self.spins)
+
+                model_spins, model_pairs = self.moments(compiled, self.sampler.observed(self.spins))
+
+                # Gradient ascent of the log-likelihood, as dE/dh_i = s_i and
+                # dE/dJ_ij = s_i s_j
+                h += rate * (model_spins - data_spins)
+                couplings += rate * (model_pairs - data_pairs)
+
+                compiled = compiled.with_coefficients(h, couplings)
+
+                if (iteration + 1) % 100 == 0:
+                    self.debug("Iteration {}: largest moment mismatch {:.4f}".format(
+                        iteration + 1,
+                        max(numpy.abs(model_spins - data_spins).max(initial=0),
+                            numpy.abs(model_pairs - data_pairs).max(initial=0))
+                    ))
+        finally:
+            model.update(h, couplings)
+
+        return model
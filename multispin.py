@@ -0,0 +1,195 @@
+"""
+Multi-spin coded sampling of nearest-neighbour grid models, such as the ones
+generated by GridBuilder. Every lattice site holds the spins of 64 chains as
+the bits of a single uint64 word, so that a sweep updates 64 chains with
+every bitwise operation.
+"""
+
+import numpy
+
+# Number of chains packed in a single word
+WORD_BITS = 64
+
+# Words are stored and viewed as bytes in little-endian order, so that bit k
+# of a word is the k-th chain in its byte expansion as well
+WORD = numpy.dtype('<u8')
+
+
+class PackedSpins(object):
+    """
+    Spins of n_chains chains packed in a (variables, words) uint64 array,
+    bit k of words[i, w] being set if the variable i of chain
+    64 * w + k has the value +1.
+    """
+
+    def __init__(self, words, n_chains):
+        self.words = words
+        self.n_chains = n_chains
+
+    @classmethod
+    def pack(cls, spins):
+        """
+        Packs a (chains, variables) matrix of spins.
+        """
+
+        spins = numpy.atleast_2d(spins)
+        n_chains, n_variables = spins.shape
+        n_words = -(-n_chains // WORD_BITS)
+
+        bits = numpy.zeros((n_variables, n_words * WORD_BITS), dtype=bool)
+        bits[:, :n_chains] = spins.T > 0
+
+        words = numpy.packbits(bits, axis=1, bitorder='little').view(WORD)
+        return cls(words, n_chains)
+
+    def unpack(self):
+        """
+        Returns the (chains, variables) int8 matrix of the spins.
+        """
+
+        bits = numpy.unpackbits(self.words.view(numpy.uint8), axis=1, bitorder='little')
+        return numpy.where(bits[:, :self.n_chains].T, 1, -1).astype(numpy.int8)
+
+
+class MultispinLattice(object):
+    """
+    Heat bath sampler of a width x height grid model with zero biases and
+    couplings of a single magnitude, in the variable layout of GridBuilder.
+
+    The couplings may differ in sign, and missing couplings are allowed. The
+    energy change of flipping a spin then only depends on the number of its
+    unsatisfied couplings, which is counted for 64 chains at once with
+    bit-sliced additions of the XORs of neighbouring words.
+
+    Raises ValueError if the compiled model is not such a lattice.
+    """
+
+    # Offsets of the right, left, lower and upper neighbours
+    DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+    def __init__(self, compiled, width, height):
+        n_variables = width * height
+
+        if compiled.variables != tuple(range(n_variables)):
+            raise ValueError("Variables do not form a free {}x{} lattice".format(width, height))
+
+        if numpy.any(compiled.h != 0):
+            raise ValueError("Multi-spin coding requires zero biases")
+
+        magnitudes = numpy.unique(numpy.abs(compiled.edge_couplings[compiled.edge_couplings != 0]))
+        if len(magnitudes) > 1:
+            raise ValueError("Multi-spin coding requires couplings of a single magnitude")
+
+        self.width = width
+        self.height = height
+        self.coupling = float(magnitudes[0]) if len(magnitudes) else 0.0
+
+        couplings = {}
+        for (node1, node2), coupling in zip(compiled.edges.tolist(), compiled.edge_couplings.tolist()):
+            if coupling:
+                couplings[node1, node2] = couplings[node2, node1] = coupling
+
+        x, y = numpy.meshgrid(numpy.arange(width), numpy.arange(height))
+        x, y = x.reshape(-1), y.reshape(-1)
+
+        # Neighbour of every site in every direction, sites on the boundary
+        # point to themselves with an absent coupling
+        self.neighbours = numpy.zeros((n_variables, 4), dtype=numpy.intp)
+        self.present = numpy.zeros((n_variables, 4), dtype=WORD)
+        self.antiparallel = numpy.zeros((n_variables, 4), dtype=WORD)
+
+        for direction, (dx, dy) in enumerate(self.DIRECTIONS):
+            inside = (0 <= x + dx) & (x + dx < width) & (0 <= y + dy) & (y + dy < height)
+            neighbours = numpy.where(inside, (y + dy) * width + x + dx, y * width + x)
+            self.neighbours[:, direction] = neighbours
+
+            for site, neighbour in enumerate(neighbours.tolist()):
+                coupling = couplings.pop((site, neighbour), 0) if neighbour != site else 0
+
+                # A positive coupling is satisfied by antiparallel spins
+                self.present[site, direction] = ~WORD.type(0) if coupling else 0
+                self.antiparallel[site, direction] = ~WORD.type(0) if coupling > 0 else 0
+
+        if couplings:
+            raise ValueError("Couplings do not follow the {}x{} lattice".format(width, height))
+
+        self.degree = numpy.count_nonzero(self.present, axis=1)
+
+        # The lattice is bipartite, sites of one parity are independent
+        parity = (x + y) % 2
+        self.colours = [numpy.flatnonzero(parity == colour) for colour in (0, 1)]
+
+    def initial_state(self, n_chains, rng):
+        """
+        Returns uniformly random packed spins.
+        """
+
+        n_words = -(-n_chains // WORD_BITS)
+        words = rng.integers(
+            numpy.iinfo(WORD).max, size=(self.width * self.height, n_words),
+            dtype=WORD, endpoint=True
+        )
+
+        return PackedSpins(words, n_chains)
+
+    def unsatisfied(self, words, rows):
+        """
+        Counts the unsatisfied couplings of the given sites in every chain,
+        returned as the three bit planes of the count.
+        """
+
+        neighbours = words[self.neighbours[rows]]
+        flags = (words[rows, None] ^ neighbours ^ self.antiparallel[rows, :, None]) & \
+            self.present[rows, :, None]
+        a, b, c, d = flags[:, 0], flags[:, 1], flags[:, 2], flags[:, 3]
+
+        # Add the four one-bit flags with half and full adders
+        low_ab, carry_ab = a ^ b, a & b
+        low_cd, carry_cd = c ^ d, c & d
+        bit0, carry = low_ab ^ low_cd, low_ab & low_cd
+        carries = carry_ab ^ carry_cd
+        bit1 = carries ^ carry
+        bit2 = (carry_ab & carry_cd) | (carries & carry)
+
+        return bit0, bit1, bit2
+
+    def sweeper(self, temperature, rng):
+        """
+        Returns a function which sweeps the packed spins in place, updating
+        one parity of the checkerboard at a time.
+        """
+
+        if numpy.ndim(temperature):
+            raise ValueError("Multi-spin coded chains share a single temperature")
+
+        # Heat bath probability of flipping a spin with the given degree and
+        # number of unsatisfied couplings, 2 |J| (degree - 2 unsatisfied)
+        # being the energy change of the flip
+        degrees, counts = numpy.meshgrid(numpy.arange(5), numpy.arange(5), indexing='ij')
+        exponent = numpy.clip(2 * self.coupling * (degrees - 2 * counts) / temperature, -700, 700)
+        flip_probabilities = 1.0 / (1.0 + numpy.exp(exponent))
+
+        blocks = [
+            (rows, flip_probabilities[self.degree[rows]].astype(numpy.float32))
+            for rows in self.colours
+        ]
+
+        def sweep(spins):
+            words = spins.words
+            n_words = words.shape[1]
+
+            for rows, probabilities in blocks:
+                bit0, bit1, bit2 = self.unsatisfied(words, rows)
+                draws = rng.random((len(rows), n_words * WORD_BITS), dtype=numpy.float32)
+
+                flips = numpy.zeros_like(bit0)
+                for count, selected in enumerate([
+                    ~bit0 & ~bit1 & ~bit2, bit0 & ~bit1, ~bit0 & bit1, bit0 & bit1, bit2
+                ]):
+                    accepted = draws < probabilities[:, count, None]
+                    accepted = numpy.packbits(accepted, axis=1, bitorder='little').view(WORD)
+                    flips |= selected & accepted
+
+                words[rows] ^= flips
+
+        return sweep
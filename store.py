@@ -0,0 +1,292 @@
+"""
+Disk-backed storage of the samples of long runs, which would not fit in a
+SamplePool in memory, in the packed columnar layout of SamplePool.to_wire().
+"""
+
+import json
+import os
+
+import numpy
+
+from data import SamplePool
+
+
+class SampleStore(object):
+    """
+    Append-only store of the distinct samples of a model and their counts in
+    a directory, read back by memory-mapping.
+
+    The samples are written in chunks. Every chunk holds the bit-packed
+    states first seen in it with their energies, followed by the positions
+    of all the states it adds among the distinct states of the store and
+    the number of their occurences; the count of a state is the sum over
+    the chunks. The writer keeps an index of the packed states to find
+    their positions, which is rebuilt from the chunks when the store is
+    opened again.
+
+    Chunk files are renamed into place once complete, and only then listed
+    in the manifest, which is itself replaced atomically. Readers opened in
+    the 'r' mode thus only see whole chunks, and pick up the chunks
+    appended since by refresh(), while a single writer keeps appending.
+
+    Takes:
+      - path: Directory of the store, created in the 'a' mode if missing.
+      - model: The IsingModel of the samples.
+      - mode: 'a' to append to the store, or 'r' to read it.
+      - chunk_size: Number of added states buffered before they are
+                    written as a chunk.
+    """
+
+    MANIFEST = 'manifest.json'
+    COLUMNS = ('rows', 'energies', 'positions', 'counts')
+
+    def __init__(self, path, model, mode='a', chunk_size=2**16):
+        if mode not in ('a', 'r'):
+            raise ValueError("Unknown store mode: {}".format(mode))
+
+        self.path = path
+        self.model = model
+        self.compiled = model.compile()
+        self.mode = mode
+        self.chunk_size = chunk_size
+
+        # Memory-mapped columns of the written chunks
+        self.chunks = []
+        self.size = 0
+
+        # Index of the packed states and the chunk being filled, used by
+        # the writer only
+        self.index = dict()
+        self.buffer = {column: [] for column in self.COLUMNS}
+        self.buffered = 0
+
+        manifest = os.path.join(path, self.MANIFEST)
+
+        if not os.path.exists(manifest):
+            if mode == 'r':
+                raise ValueError("No sample store at {}".format(path))
+
+            os.makedirs(path, exist_ok=True)
+            self.write_manifest()
+
+        self.refresh()
+
+        if mode == 'a':
+            position = 0
+            for chunk in self.chunks:
+                for row in chunk['rows']:
+                    self.index[row.tobytes()] = position
+                    position += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        """
+        Return the number of samples in the written chunks.
+        """
+
+        return int(sum(chunk['counts'].sum() for chunk in self.chunks))
+
+    def filename(self, number, column):
+        """
+        Returns the path of the file of the column of the given chunk.
+        """
+
+        return os.path.join(self.path, '{:06d}.{}.npy'.format(number, column))
+
+    def write_manifest(self):
+        """
+        Replaces the manifest with the one listing the written chunks.
+        """
+
+        manifest = os.path.join(self.path, self.MANIFEST)
+        temporary = manifest + '.tmp'
+
+        with open(temporary, 'w') as f:
+            json.dump({'n_variables': len(self.compiled), 'chunks': len(self.chunks)}, f)
+
+        os.replace(temporary, manifest)
+
+    def refresh(self):
+        """
+        Maps the chunks listed in the manifest which are not mapped yet.
+        """
+
+        with open(os.path.join(self.path, self.MANIFEST)) as f:
+            manifest = json.load(f)
+
+        if manifest['n_variables'] != len(self.compiled):
+            raise ValueError("Store does not match the {} variables of the model"
+                             .format(len(self.compiled)))
+
+        for number in range(len(self.chunks), manifest['chunks']):
+            chunk = {
+                column: numpy.load(self.filename(number, column), mmap_mode='r')
+                for column in self.COLUMNS
+            }
+
+            self.chunks.append(chunk)
+            self.size += len(chunk['rows'])
+
+    def add(self, sample):
+        """
+        Adds the IsingSample to the store.
+        """
+
+        state = self.compiled.to_state(sample.assignment)
+        self.add_states(state, [sample.occurences], [sample.energy])
+
+    def add_states(self, states, counts=None, energies=None):
+        """
+        Adds the rows of a (samples, variables) matrix of states over the
+        compiled variables of the model, each occuring once unless counts are
+        given. The energies are computed unless given.
+        """
+
+        states = numpy.atleast_2d(states)
+        counts = numpy.ones(len(states), dtype=numpy.int64) if counts is None \
+            else numpy.asarray(counts, dtype=numpy.int64).reshape(-1)
+        energies = self.compiled.energy(states) if energies is None else energies
+
+        self.append(
+            numpy.packbits(states > 0, axis=1), counts,
+            numpy.asarray(energies, dtype=float).reshape(-1)
+        )
+
+    def add_pool(self, pool):
+        """
+        Adds the samples of a SamplePool of the model to the store. Raises
+        ValueError for bounded pools which evicted samples, since the store
+        keeps every sample it counts.
+        """
+
+        if pool.evicted:
+            raise ValueError("Cannot store a pool which evicted {} samples".format(pool.evicted))
+
+        if pool.model is not None:
+            wire = pool.to_wire()
+            self.append(wire['rows'], wire['counts'], wire['energies'])
+
+    def append(self, packed, counts, energies):
+        """
+        Buffers the packed states with their counts and energies, writing
+        out a chunk once chunk_size states are buffered.
+        """
+
+        if self.mode != 'a':
+            raise ValueError("Sample store is opened for reading")
+
+        positions = numpy.empty(len(packed), dtype=numpy.int64)
+        new = []
+
+        for number, row in enumerate(packed):
+            key = row.tobytes()
+            position = self.index.get(key)
+
+            if position is None:
+                position = self.index[key] = len(self.index)
+                new.append(number)
+
+            positions[number] = position
+
+        self.buffer['rows'].append(packed[new])
+        self.buffer['energies'].append(energies[new])
+        self.buffer['positions'].append(positions)
+        self.buffer['counts'].append(counts)
+        self.buffered += len(packed)
+
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered states as a new chunk and lists it in the
+        manifest.
+        """
+
+        if not self.buffered:
+            return
+
+        # Aggregate the counts of the states added repeatedly to the chunk
+        positions, inverse = numpy.unique(numpy.concatenate(self.buffer['positions']),
+                                          return_inverse=True)
+        counts = numpy.bincount(inverse.reshape(-1), weights=numpy.concatenate(self.buffer['counts']),
+                                minlength=len(positions))
+
+        columns = {
+            'rows': numpy.concatenate(self.buffer['rows']).reshape(-1, (len(self.compiled) + 7) // 8),
+            'energies': numpy.concatenate(self.buffer['energies']),
+            'positions': positions,
+            'counts': counts.astype(numpy.int64),
+        }
+
+        number = len(self.chunks)
+        for column, array in columns.items():
+            temporary = self.filename(number, column) + '.tmp'
+            with open(temporary, 'wb') as f:
+                numpy.save(f, array)
+            os.replace(temporary, self.filename(number, column))
+
+        self.chunks.append({
+            column: numpy.load(self.filename(number, column), mmap_mode='r')
+            for column in self.COLUMNS
+        })
+        self.size += len(columns['rows'])
+        self.write_manifest()
+
+        self.buffer = {column: [] for column in self.COLUMNS}
+        self.buffered = 0
+
+    def close(self):
+        """
+        Writes out the buffered states, if any.
+        """
+
+        if self.mode == 'a':
+            self.flush()
+
+    def counts(self):
+        """
+        Returns the counts of the distinct states of the written chunks, in
+        the order in which the states were first added.
+        """
+
+        counts = numpy.zeros(self.size, dtype=numpy.int64)
+        for chunk in self.chunks:
+            counts[chunk['positions']] += chunk['counts']
+
+        return counts
+
+    def to_pool(self, capacity=None, bin_width=None):
+        """
+        Loads the written samples into a SamplePool, which may be bounded
+        to the given number of the best distinct samples to keep the memory
+        footprint small, see SamplePool.
+        """
+
+        pool = SamplePool(capacity=capacity, bin_width=bin_width)
+        pool.bind(self.model)
+
+        counts = self.counts()
+        start = 0
+
+        for chunk in self.chunks:
+            stop = start + len(chunk['rows'])
+            energies = numpy.asarray(chunk['energies'])
+
+            pool.insert(numpy.asarray(chunk['rows']), counts[start:stop], energies)
+            pool.accumulate(energies, counts[start:stop])
+            start = stop
+
+        return pool
+
+    def n_best(self, number):
+        """
+        Retrieve the N best samples.
+        """
+
+        return self.to_pool(capacity=number)[:number]
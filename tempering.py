@@ -0,0 +1,183 @@
+import numpy
+
+from gibbs import GibbsSampler
+
+
+class TemperingSampler(GibbsSampler):
+    """
+    Samples the model using parallel tempering (replica exchange). Replicas
+    of the chain are run on a ladder of temperatures and neighbouring
+    replicas regularly propose to exchange their states, which lets the
+    low temperature replica escape local minima through the hot ones.
+
+    Takes, in addition to GibbsSampler arguments:
+      - n_replicas: Number of temperatures in the ladder.
+      - max_temperature: The highest temperature of the ladder, the lowest
+                         being the target temperature.
+      - swap_interval: Number of sweeps between two rounds of swap proposals.
+    """
+
+    def __init__(self, burnin=None, step=None, n_variables=None, method='site',
+                 n_jobs=1, seed=None, adaptive=False, target_rhat=1.01,
+                 quantum=None, jit=True, checkpoint_interval=600, moments=False,
+                 n_replicas=8, max_temperature=5, swap_interval=1):
+        GibbsSampler.__init__(
+            self, burnin=burnin, step=step, n_variables=n_variables,
+            method=method, n_jobs=n_jobs, seed=seed, adaptive=adaptive,
+            target_rhat=target_rhat, quantum=quantum, jit=jit,
+            checkpoint_interval=checkpoint_interval, moments=moments
+        )
+
+        if n_replicas < 2:
+            raise ValueError("Parallel tempering needs at least two replicas")
+
+        self.n_replicas = n_replicas
+        self.max_temperature = max_temperature
+        self.swap_interval = swap_interval
+
+    def ladder(self, temperature):
+        """
+        Returns the geometrically spaced ladder of temperatures, starting at
+        the target temperature.
+        """
+
+        return numpy.geomspace(
+            temperature,
+            max(self.max_temperature, temperature),
+            self.n_replicas
+        )
+
+    def initial_state(self, compiled, n_chains, rng=None, states=None):
+        """
+        Every chain is represented by a block of n_replicas consecutive rows,
+        ordered by temperature. All the replicas of a chain start from its
+        given state.
+        """
+
+        if states is not None:
+            states = numpy.repeat(states, self.n_replicas, axis=0)
+
+        return GibbsSampler.initial_state(
+            self, compiled, n_chains * self.n_replicas, rng, states
+        )
+
+    def sweeper(self, compiled, temperature, n_chains, rng=None, iteration=0):
+        """
+        Returns a function which sweeps every replica at its temperature and
+        proposes the swaps between the neighbouring replicas. The phase of
+        the swaps continues from the given number of sweeps already
+        performed, so that a resumed run proposes the same swaps.
+        """
+
+        rng = rng or self.rng
+        temperatures = self.ladder(temperature)
+        betas = 1.0 / temperatures
+
+        # Swap statistics of the run, per pair of neighbouring temperatures
+        self.attempted = numpy.zeros(self.n_replicas - 1, dtype=numpy.int64)
+        self.accepted = numpy.zeros(self.n_replicas - 1, dtype=numpy.int64)
+
+        sweep_replicas = GibbsSampler.sweeper(
+            self, compiled,
+            numpy.tile(temperatures, n_chains),
+            n_chains * self.n_replicas,
+            rng
+        )
+
+        def sweep(spins):
+            nonlocal iteration
+
+            sweep_replicas(spins)
+
+            iteration += 1
+            if iteration % self.swap_interval:
+                return
+
+            replicas = spins.reshape(n_chains, self.n_replicas, -1)
+            energies = compiled.energy(replicas)
+
+            # Alternate between even and odd pairs from one round of swaps to
+            # the next, so that no replica takes part in two proposals at once
+            for lower in range((iteration // self.swap_interval) % 2, self.n_replicas - 1, 2):
+                upper = lower + 1
+
+                delta = (betas[lower] - betas[upper]) * \
+                    (energies[:, lower] - energies[:, upper])
+                accepted = numpy.log(rng.random(n_chains)) < delta
+
+                self.attempted[lower] += n_chains
+                self.accepted[lower] += accepted.sum()
+
+                replicas[accepted, lower], replicas[accepted, upper] = \
+                    replicas[accepted, upper], replicas[accepted, lower]
+                energies[accepted, lower], energies[accepted, upper] = \
+                    energies[accepted, upper], energies[accepted, lower]
+
+        return sweep
+
+    def observed(self, spins):
+        """
+        Only the replicas at the target temperature are recorded.
+        """
+
+        return spins[::self.n_replicas]
+
+    def run_chains(self, model, num_samples, temperature=1, n_chains=1, rng=None,
+                   spins=None, burnin=None, checkpoint=None, resumed=None,
+                   statistics=None):
+        """
+        Runs the chains and records the swap acceptance rate of every pair of
+        neighbouring temperatures in the diagnostics of the pool. The swap
+        statistics of a resumed run only cover its last part. The numbers of
+        attempted and accepted swaps are added to the statistics if given.
+        """
+
+        # The statistics of a run which ends before its first sweep
+        self.attempted = numpy.zeros(self.n_replicas - 1, dtype=numpy.int64)
+        self.accepted = numpy.zeros(self.n_replicas - 1, dtype=numpy.int64)
+
+        pool = GibbsSampler.run_chains(
+            self, model, num_samples, temperature, n_chains, rng, spins, burnin,
+            checkpoint, resumed, statistics
+        )
+
+        pool.diagnostics.update(self.swap_diagnostics(temperature, self.attempted, self.accepted))
+
+        if statistics is not None:
+            statistics['attempted'] = self.attempted
+            statistics['accepted'] = self.accepted
+
+        return pool
+
+    def merge_partials(self, model, temperature, partials):
+        """
+        Sums the swap statistics of all the workers before computing the
+        acceptance rates.
+        """
+
+        pool = GibbsSampler.merge_partials(self, model, temperature, partials)
+
+        attempted = sum(statistics['attempted'] for _, _, _, statistics in partials)
+        accepted = sum(statistics['accepted'] for _, _, _, statistics in partials)
+        pool.diagnostics.update(self.swap_diagnostics(temperature, attempted, accepted))
+
+        return pool
+
+    def swap_diagnostics(self, temperature, attempted, accepted):
+        """
+        Returns the ladder of temperatures, and the number of attempted swaps
+        and the swap acceptance rate of every pair of neighbouring
+        temperatures. The rate of a pair without attempts is NaN.
+        """
+
+        attempted = numpy.asarray(attempted)
+
+        acceptance = numpy.where(
+            attempted > 0, accepted / numpy.maximum(attempted, 1), numpy.nan
+        )
+
+        return {
+            'temperatures': self.ladder(temperature).tolist(),
+            'swap_attempts': attempted.tolist(),
+            'swap_acceptance': acceptance.tolist(),
+        }
@@ -1,6 +1,11 @@
+import math
+import pickle
+
+import numpy
 import pytest
 
-from data import IsingSample, IsingModel, SamplePool
+from data import EnergyDensity, IsingSample, IsingModel, SamplePool
+from store import SampleStore
 
 
 class TestIsingModel(object):
@@ -91,6 +96,145 @@ class TestIsingModel(object):
         assert deserialized.J == J
 
 
+class TestCompiledIsingModel(object):
+    """
+    Tests the array-backed form of the IsingModel.
+    """
+
+    def test_compile_cached_and_invalidated(self):
+        """
+        Test that the compiled model is cached and invalidated by clamping.
+        """
+
+        h = {0: 4.5, 1: 10, 2: -5}
+        J = {(0, 1): -4.5, (1, 2): 5}
+
+        model = IsingModel(J, h)
+        compiled = model.compile()
+
+        assert model.compile() is compiled
+        assert compiled.variables == (0, 1, 2)
+
+        model.clamp(0, 1)
+
+        assert model.compile() is not compiled
+        assert model.compile().variables == (1, 2)
+        assert list(model.compile().h) == [5.5, -5]
+        assert model.compile().energy_offset == 4.5
+
+    def test_compiled_adjacency(self):
+        """
+        Test that the CSR structure lists every coupling in both directions.
+        """
+
+        h = {0: 1}
+        J = {(0, 1): -1.5, (1, 2): 2, (3, 0): 0.5}
+
+        compiled = IsingModel(J, h).compile()
+
+        assert list(compiled.indptr) == [0, 2, 4, 5, 6]
+        assert list(compiled.indices) == [1, 3, 0, 2, 1, 0]
+        assert list(compiled.couplings) == [-1.5, 0.5, -1.5, 2, 2, 0.5]
+
+        with pytest.raises(ValueError):
+            compiled.h[0] = 5
+
+    def test_colour_classes(self):
+        """
+        Test that the colour classes contain no coupled variables, and that
+        bipartite models need only two colours.
+        """
+
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={})
+        classes = checkerboard.compile().colour_classes()
+        assert sorted(map(list, classes)) == [[0, 2], [1, 3]]
+
+        triangle = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 0): 1, (2, 3): 1}, h={})
+        compiled = triangle.compile()
+        classes = compiled.colour_classes()
+
+        assert len(classes) == 3
+        for rows in classes:
+            for node1, node2 in compiled.edges:
+                assert not (node1 in rows and node2 in rows)
+
+    def test_connected_components(self):
+        """
+        Test that the variables connected by the selected edges share a root.
+        """
+
+        J = {(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 4): 1, (4, 5): 1}
+        compiled = IsingModel(J, {}).compile()
+
+        roots = compiled.connected_components([True, True, False, False, True])
+
+        assert roots[0] == roots[1] == roots[2]
+        assert roots[4] == roots[5]
+        assert len(set(roots.tolist())) == 3
+
+    def test_compiled_energy_and_fields(self):
+        """
+        Test that the compiled model computes energies and local fields.
+        """
+
+        h = {0: 5.2, 1: 4, 2: -8}
+        J = {(0, 1): -2.5, (1, 2): 3}
+        compiled = IsingModel(J, h).compile()
+
+        states = [[-1, -1, -1], [1, -1, 1]]
+        energies = compiled.energy(states)
+
+        assert energies[0] == pytest.approx(-0.7)
+        assert energies[1] == pytest.approx(5.2 - 4 - 8 + 2.5 - 3)
+
+        # Energies computed one row at a time are the same
+        compiled.ENERGY_BLOCK = 1
+        assert compiled.energy(states).tolist() == energies.tolist()
+
+        fields = compiled.local_fields(states)
+        assert list(fields[1]) == pytest.approx([5.2 + 2.5, 4 - 2.5 + 3, -8 - 3])
+
+    def test_quantized_energies(self):
+        """
+        Test that decimal coefficients are detected and that their energies
+        are computed exactly.
+        """
+
+        h = {0: 0.1, 1: 0.2, 2: -0.35}
+        J = {(0, 1): 0.7, (1, 2): -0.05}
+        compiled = IsingModel(J, h).compile()
+
+        assert compiled.quantum() == 0.01
+        assert compiled.quantized(0.05).h.tolist() == [2, 4, -7]
+        assert compiled.energy([1, 1, 1]) == 0.6
+
+        with pytest.raises(ValueError):
+            compiled.quantized(0.1)
+
+        irrational = IsingModel({(0, 1): 2 ** 0.5}, {}).compile()
+        assert irrational.quantum() is None
+
+    def test_update_copies_coefficients(self):
+        """
+        Test that updating the coefficients keeps the compiled model apart
+        from the vectors given.
+        """
+
+        model = IsingModel(J={(0, 1): 1}, h={0: 0.1, 1: 0.2})
+
+        h = numpy.array([0.3, 0.4])
+        couplings = numpy.array([0.5])
+        model.update(h, couplings)
+
+        h += 10
+        couplings += 10
+
+        assert model.h == {0: 0.3, 1: 0.4}
+        assert model.compile().h.tolist() == [0.3, 0.4]
+        assert model.compile().edge_couplings.tolist() == [0.5]
+        assert model.compile().quantum() == 0.1
+
+
 class TestIsingSample(object):
     """
     Test the IsingSample class.
@@ -501,3 +645,206 @@ class TestSamplePool(object):
         assert len(pool) == 2
         assert pool[0].occurences == 6
         assert pool[1].occurences == 20
+
+    def test_add_states(self):
+        """
+        Test that states added in bulk are aggregated like added samples.
+        """
+
+        simple = IsingModel(
+            J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1},
+            h={0: -3}
+        )
+
+        states = [[1, 1, 1, 1], [-1, 1, -1, 1], [1, 1, 1, 1], [1, -1, 1, -1]]
+
+        bulk = SamplePool()
+        bulk.add_states(simple, states[:2])
+        bulk.add_states(simple, states[2:], counts=[2, 1])
+
+        pool = SamplePool()
+        for state, count in zip(states, [1, 1, 2, 1]):
+            pool.add(IsingSample(simple, state, count))
+
+        assert len(bulk) == len(pool) == 5
+        assert bulk[:1000] == pool[:1000]
+        assert [sample.occurences for sample in bulk] == [sample.occurences for sample in pool]
+        assert bulk.mean_energy == pytest.approx(pool.mean_energy)
+        assert bulk.KL_divergence(10, 1) == pytest.approx(pool.KL_divergence(10, 1))
+
+    def test_capacity(self):
+        """
+        Test that a bounded pool keeps the best samples and accounts for the
+        evicted ones.
+        """
+
+        simple = IsingModel(
+            J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1},
+            h={0: -3}
+        )
+
+        samples = [
+            IsingSample(simple, [1, 1, 1, 1], occurences=3),
+            IsingSample(simple, [-1, 1, -1, 1], occurences=2),
+            IsingSample(simple, [1, -1, 1, -1], occurences=4),
+            IsingSample(simple, [-1, -1, -1, -1]),
+        ]
+
+        pool = SamplePool(samples, capacity=2)
+        unbounded = SamplePool(samples)
+
+        assert pool[:1000] == unbounded[:2]
+        assert len(pool) == len(unbounded) == 10
+        assert pool.evicted == 4
+        assert pool.mean_energy == pytest.approx(unbounded.mean_energy)
+
+    def test_energy_statistics(self):
+        """
+        Test that the running energy statistics match the raw data.
+        """
+
+        simple = IsingModel(
+            J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1},
+            h={0: -3}
+        )
+
+        pool = SamplePool(bin_width=4)
+        pool.add_states(simple, [[1, 1, 1, 1], [-1, 1, -1, 1]], counts=[3, 2])
+        pool.add(IsingSample(simple, [1, -1, 1, -1], occurences=4))
+        pool.add(IsingSample(simple, [1, 1, 1, 1]))
+
+        raw_data = pool.raw_data
+
+        assert pool.mean_energy == pytest.approx(sum(raw_data) / len(raw_data))
+        assert pool.specific_heat(2) == pytest.approx(
+            sum((energy - pool.mean_energy) ** 2 for energy in raw_data) / len(raw_data) / 4
+        )
+        assert pool.to_energy_histogram() == {0: 6, -8: 4}
+
+    def test_merge_and_pickle(self):
+        """
+        Test that merged and unpickled pools equal the pool of all samples.
+        """
+
+        simple = IsingModel(
+            J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1},
+            h={0: -3}
+        )
+
+        states = [[1, 1, 1, 1], [-1, 1, -1, 1], [1, 1, 1, 1], [1, -1, 1, -1]]
+
+        first = SamplePool.from_arrays(simple, states[:2], [3, 2])
+        second = SamplePool.from_arrays(simple, states[2:], [1, 4])
+        pool = SamplePool.from_arrays(simple, states, [3, 2, 1, 4])
+
+        merged = SamplePool().merge(first).merge(pickle.loads(pickle.dumps(second)))
+
+        # The compiled form of the model is not pickled along with it
+        assert simple._compiled is not None
+        assert pickle.loads(pickle.dumps(simple))._compiled is None
+
+        assert len(merged) == len(pool) == 10
+        assert merged[:1000] == pool[:1000]
+        assert [sample.occurences for sample in merged] == [sample.occurences for sample in pool]
+        assert merged.specific_heat(1) == pytest.approx(pool.specific_heat(1))
+        assert merged.to_energy_histogram() == pool.to_energy_histogram()
+
+    def test_energy_density_reweighting(self):
+        """
+        Test that the histograms of a two level system, sampled in exact
+        Boltzmann proportions, reweight to the other temperatures.
+        """
+
+        model = IsingModel(J={}, h={0: 1})
+
+        def boltzmann_pool(temperature):
+            up = int(round(10 ** 6 / (1 + math.exp(2 / temperature))))
+            return SamplePool([
+                IsingSample(model, [1], up),
+                IsingSample(model, [-1], 10 ** 6 - up),
+            ])
+
+        single = boltzmann_pool(1).energy_density(1)
+        multi = EnergyDensity.from_pools({1: boltzmann_pool(1), 3: boltzmann_pool(3)})
+
+        for density in (single, multi):
+            assert density.mean_energy(2) == pytest.approx(-math.tanh(0.5), abs=1e-4)
+            assert density.specific_heat(2) == pytest.approx(0.25 / math.cosh(0.5) ** 2, abs=1e-4)
+            assert density.partition_function_ratio(2, 1) == \
+                pytest.approx(math.cosh(0.5) / math.cosh(1), abs=1e-4)
+
+    def test_reweighted_KL_divergence(self):
+        """
+        Test that samples drawn in exact Boltzmann proportions, reweighted to
+        another temperature, match the Boltzmann distribution there.
+        """
+
+        model = IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 0): 0.3}, h={1: 0.2})
+        states = [[(number >> bit & 1) * 2 - 1 for bit in range(3)] for number in range(8)]
+        energies = [IsingSample(model, state).energy for state in states]
+
+        weights = [math.exp(-energy) for energy in energies]
+        pool = SamplePool([
+            IsingSample(model, state, int(round(10 ** 6 * weight / sum(weights))))
+            for state, weight in zip(states, weights)
+        ])
+
+        Z = sum(math.exp(-energy / 2) for energy in energies)
+        data, boltzmann = pool.probabilities(Z, 2, sampled=1)
+
+        assert list(data) == pytest.approx(list(boltzmann), abs=1e-5)
+        assert pool.KL_divergence(Z, 2, sampled=1) == pytest.approx(0, abs=1e-6)
+        assert pool.reverse_KL_divergence(Z, 2, sampled=1) == pytest.approx(0, abs=1e-6)
+
+        # Without the reweighting, the samples do not follow the distribution
+        assert pool.KL_divergence(Z, 2) > 0.01
+
+
+class TestSampleStore(object):
+    """
+    Tests the disk-backed SampleStore.
+    """
+
+    def test_append_and_read(self, tmpdir):
+        """
+        Test that the stored samples are deduplicated across chunks and
+        reopenings, and visible to a reader as the chunks are written.
+        """
+
+        simple = IsingModel(
+            J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1},
+            h={0: -3}
+        )
+
+        states = [[1, 1, 1, 1], [-1, 1, -1, 1], [1, 1, 1, 1], [1, -1, 1, -1]]
+        path = str(tmpdir.join('store'))
+
+        writer = SampleStore(path, simple, chunk_size=2)
+        reader = SampleStore(path, simple, mode='r')
+
+        writer.add_states(states[:3])
+        reader.refresh()
+        assert len(reader) == 3
+
+        writer.add(IsingSample(simple, states[3], occurences=4))
+        writer.close()
+
+        with SampleStore(path, simple) as appender:
+            appender.add_states(states[:1], counts=[2])
+
+        reader.refresh()
+        pool = SamplePool.from_arrays(simple, states, [4, 1, 0, 4])
+
+        assert len(reader) == len(pool) == 9
+        assert reader.to_pool()[:1000] == pool[:1000]
+        assert reader.n_best(1) == pool[:1]
+        assert reader.to_pool().mean_energy == pytest.approx(pool.mean_energy)
+
+        with SampleStore(path, simple) as appender:
+            appender.add_pool(SamplePool.from_arrays(simple, states[:2], [1, 1]))
+
+            with pytest.raises(ValueError):
+                appender.add_pool(SamplePool.from_wire(simple, pool.to_wire(), capacity=1))
+
+        reader.refresh()
+        assert len(reader) == 11
@@ -2,11 +2,17 @@
 Contains D-Wave specific tests.
 """
 
+import math
+
 import pytest
 
-from data import IsingModel
+from data import IsingModel, IsingSample, SamplePool
+from diagnostics import autocorrelation_time, split_rhat
+from annealing import AnnealingSampler
 from dwave import DWaveSampler
 from gibbs import GibbsSampler
+from learning import ContrastiveDivergence
+from tempering import TemperingSampler
 from config import DWAVE_SOLVER
 
 
@@ -91,3 +97,537 @@ class TestGibbsSampler(object):
         solutions = [s.as_tuple for s in result]
         assert (1, -1, 1, -1) in solutions
         assert len(solutions) == 1
+
+    def test_node_probability_matches_energies(self):
+        """
+        Test that the local field conditional agrees with the conditional
+        computed from the full energies of the two possible samples.
+        """
+
+        model = IsingModel(
+            J={(0, 1): 1.5, (1, 2): -0.5, (2, 3): 2, (3, 0): -1, (0, 2): 0.25},
+            h={0: 0.3, 2: -1.2}
+        )
+        model.clamp(3, -1)
+
+        sampler = GibbsSampler(n_variables=3)
+        assignment = {0: 1, 1: -1, 2: 1}
+        temperature = 1.7
+
+        for variable in (0, 1, 2):
+            energies = {}
+            for value in (-1, 1):
+                changed = dict(assignment)
+                changed[variable] = value
+                energies[value] = IsingSample(model, changed).energy
+
+            weights = {
+                value: math.exp(-energy / temperature)
+                for value, energy in energies.items()
+            }
+            expected = weights[-1] / (weights[-1] + weights[1])
+
+            obtained = sampler.node_probability(model, assignment, variable, temperature)
+            assert obtained == pytest.approx(expected)
+
+    def test_block_biased_checkerboard(self):
+        """
+        Test that block sampling of the biased checkerboard returns only one
+        solution.
+        """
+
+        sampler = GibbsSampler(n_variables=4, method='block')
+        biased_checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={0: 20})
+        result = sampler.sample(biased_checkerboard, 1000, temperature=0.1)
+
+        solutions = [s.as_tuple for s in result]
+        assert solutions == [(-1, 1, -1, 1)]
+
+    def test_cluster_biased_checkerboard(self):
+        """
+        Test that cluster sampling of the biased checkerboard returns only one
+        solution.
+        """
+
+        sampler = GibbsSampler(n_variables=4, method='cluster')
+        biased_checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={0: 20})
+        result = sampler.sample(biased_checkerboard, 1000, temperature=0.1)
+
+        solutions = [s.as_tuple for s in result]
+        assert solutions == [(-1, 1, -1, 1)]
+
+    def test_multispin_unbiased_checkerboard(self):
+        """
+        Test that the multi-spin coded chains on a 2x2 lattice return both
+        checkerboard solutions, and that biased models are refused.
+        """
+
+        class Lattice(object):
+            width = 2
+            height = 2
+
+        sampler = GibbsSampler(n_variables=4, method='multispin', lattice=Lattice())
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 3): 1, (3, 2): 1, (2, 0): 1}, h={})
+        result = sampler.sample(checkerboard, 1000, temperature=0.1, n_chains=100)
+
+        solutions = sorted(s.as_tuple for s in result)
+        assert solutions == [(-1, 1, 1, -1), (1, -1, -1, 1)]
+
+        with pytest.raises(ValueError):
+            biased_checkerboard = IsingModel(J=checkerboard.J, h={0: 2})
+            sampler.sample(biased_checkerboard, 1000)
+
+    def test_multiple_chains(self):
+        """
+        Test that samples of multiple chains are collected into a single pool
+        holding exactly the requested number of samples.
+        """
+
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={})
+
+        for method in ('site', 'block', 'cluster'):
+            sampler = GibbsSampler(n_variables=4, method=method)
+            result = sampler.sample(checkerboard, 1001, n_chains=8)
+
+            solutions = [s.as_tuple for s in result]
+            assert len(result) == 1001
+            assert (-1, 1, -1, 1) in solutions
+            assert (1, -1, 1, -1) in solutions
+
+    def test_no_samples(self):
+        """
+        Test that requesting no samples returns an empty pool without
+        running the burn-in.
+        """
+
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={})
+
+        for sampler in (GibbsSampler(burnin=10 ** 9), TemperingSampler(burnin=10 ** 9),
+                        GibbsSampler(burnin=10 ** 9, n_jobs=2)):
+            assert len(sampler.sample(checkerboard, 0, n_chains=2)) == 0
+
+    def test_adaptive_burnin(self):
+        """
+        Test that the adaptive mode ends the burn-in early and reports its
+        diagnostics on the pool.
+        """
+
+        model = IsingModel(
+            J={(i, i + 1): 0.5 for i in range(19)},
+            h={0: 0.3, 10: -0.2}
+        )
+
+        sampler = GibbsSampler(method='block', adaptive=True, target_rhat=1.05)
+        result = sampler.sample(model, 500, n_chains=4)
+
+        max_burnin, _ = sampler.schedule(model.compile())
+
+        assert len(result) == 500
+        assert result.diagnostics['burnin'] < max_burnin
+        assert result.diagnostics['burnin_rhat'] < 1.05
+        assert result.diagnostics['step'] >= 1
+        assert result.diagnostics['effective_sample_size'] > 0
+
+    def test_adaptive_without_burnin(self):
+        """
+        Test that warm started adaptive chains may skip the burn-in, and that
+        the diagnostics accept traces too short to be meaningful.
+        """
+
+        ferromagnet = IsingModel(J={(0, 1): -5, (1, 2): -5, (2, 3): -5, (3, 0): -5}, h={})
+        up = {variable: 1 for variable in range(4)}
+
+        sampler = GibbsSampler(adaptive=True, seed=1)
+        result = sampler.sample(ferromagnet, 50, n_chains=2, initial=up, burnin=0)
+
+        assert len(result) == 50
+        assert result.diagnostics['burnin'] == 0
+
+        for traces in ([], [[1.0]]):
+            assert split_rhat(traces) == float('inf')
+            assert autocorrelation_time(traces) == 1.0
+
+    def test_parallel_diagnostics(self):
+        """
+        Test that the diagnostics of chains run by several workers are
+        combined in the returned pool.
+        """
+
+        model = IsingModel(J={(i, i + 1): 0.5 for i in range(9)}, h={0: 0.3})
+
+        sampler = GibbsSampler(method='block', adaptive=True, n_jobs=2, seed=1)
+        result = sampler.sample(model, 200, n_chains=2)
+
+        assert len(result) == 200
+        assert {'burnin', 'burnin_rhat', 'step', 'rhat', 'autocorrelation_time',
+                'effective_sample_size'} <= set(result.diagnostics)
+        assert len(sampler.sample(model, 0)) == 0
+
+    def test_sample_iter(self):
+        """
+        Test that the sample generator lazily yields thinned samples, or raw
+        state matrices.
+        """
+
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={0: 20})
+        sampler = GibbsSampler(burnin=10, step=2)
+
+        samples = sampler.sample_iter(checkerboard, temperature=0.1)
+        solutions = [next(samples).as_tuple for _ in range(10)]
+        assert solutions == [(-1, 1, -1, 1)] * 10
+
+        states = sampler.sample_iter(checkerboard, temperature=0.1, n_chains=3, raw=True)
+        state = next(states)
+        assert state.shape == (3, 4)
+        assert state.tolist() == [[-1, 1, -1, 1]] * 3
+
+    def test_sample_temperatures(self):
+        """
+        Test that a temperature sweep returns a pool per temperature, the
+        chains settling in the checkerboard solutions as they cool down.
+        """
+
+        sampler = GibbsSampler(n_variables=4, method='block', seed=1)
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={})
+        pools = sampler.sample_temperatures(checkerboard, [0.1, 10, 1], 200, n_chains=4)
+
+        assert sorted(pools) == [0.1, 1, 10]
+        assert all(len(pool) == 200 for pool in pools.values())
+        assert len(list(pools[10])) > 2
+        assert sorted(s.as_tuple for s in pools[0.1]) == [(-1, 1, -1, 1), (1, -1, 1, -1)]
+
+    def test_warm_start(self):
+        """
+        Test that chains started from given states stay in their minimum of
+        a strongly coupled ferromagnet, whatever form the states take.
+        """
+
+        sampler = GibbsSampler(n_variables=4, step=1, seed=1)
+        ferromagnet = IsingModel(J={(0, 1): -5, (1, 2): -5, (2, 3): -5, (3, 0): -5}, h={})
+
+        up = {variable: 1 for variable in range(4)}
+        down = IsingSample(ferromagnet, [-1, -1, -1, -1])
+
+        for initial, expected in ((up, (1, 1, 1, 1)), (SamplePool([down]), (-1, -1, -1, -1))):
+            result = sampler.sample(ferromagnet, 100, temperature=0.5, n_chains=2,
+                                    initial=initial, burnin=0)
+
+            assert [s.as_tuple for s in result] == [expected]
+
+        with pytest.raises(ValueError):
+            sampler.sample(ferromagnet, 100, initial=[[1, 1]])
+
+    def test_spin_moments(self):
+        """
+        Test that the accumulated magnetizations and correlations match the
+        exact Boltzmann averages.
+        """
+
+        model = IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 0): 1}, h={1: 0.2})
+
+        states = [[(number >> bit & 1) * 2 - 1 for bit in range(4)] for number in range(16)]
+        weights = [math.exp(-IsingSample(model, state).energy) for state in states]
+        total = sum(weights)
+
+        sampler = GibbsSampler(n_variables=4, method='block', moments=True, seed=3)
+        moments = sampler.sample(model, 20000, n_chains=10).moments
+
+        assert moments.count == 20000
+        assert moments.edges == [(0, 1), (1, 2), (2, 3), (0, 3)]
+
+        for index, variable in enumerate(moments.variables):
+            expected = sum(w * state[variable] for w, state in zip(weights, states)) / total
+            assert moments.magnetization[index] == pytest.approx(expected, abs=0.02)
+
+        for index, (node1, node2) in enumerate(moments.edges):
+            expected = sum(w * state[node1] * state[node2] for w, state in zip(weights, states)) / total
+            assert moments.correlations[index] == pytest.approx(expected, abs=0.02)
+
+    def test_seeded_chains_reproducible(self):
+        """
+        Test that samplers seeded alike produce identical samples, while
+        consecutive runs of one sampler differ.
+        """
+
+        model = IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 0): 1}, h={1: 0.2})
+        as_counts = lambda pool: sorted((s.as_tuple, s.occurences) for s in pool)
+
+        for method in ('site', 'block', 'cluster'):
+            samplers = [GibbsSampler(method=method, seed=7) for _ in range(2)]
+            results = [sampler.sample(model, 300, n_chains=3) for sampler in samplers]
+
+            assert as_counts(results[0]) == as_counts(results[1])
+
+            rerun = samplers[0].sample(model, 300, n_chains=3)
+            assert as_counts(rerun) != as_counts(results[0])
+
+    def test_parallel_chains_reproducible(self):
+        """
+        Test that worker processes merge into a single pool, and that their
+        random streams are derived deterministically from the seed.
+        """
+
+        model = IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 0): 1}, h={1: 0.2})
+
+        results = [
+            GibbsSampler(n_variables=4, n_jobs=2, seed=42).sample(model, 500)
+            for _ in range(2)
+        ]
+
+        assert len(results[0]) == 500
+        assert sorted((s.as_tuple, s.occurences) for s in results[0]) == \
+            sorted((s.as_tuple, s.occurences) for s in results[1])
+
+    def test_lookup_table_matches_exponentials(self):
+        """
+        Test that the lookup of the conditional probabilities of a quantized
+        model reproduces the chains that evaluate them directly.
+        """
+
+        model = IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 0): 1}, h={1: 0.2})
+        as_counts = lambda pool: sorted((s.as_tuple, s.occurences) for s in pool)
+
+        for method in ('site', 'block'):
+            results = [
+                GibbsSampler(method=method, seed=3, quantum=quantum).sample(model, 300, n_chains=2)
+                for quantum in (None, False)
+            ]
+
+            assert as_counts(results[0]) == as_counts(results[1])
+
+    def test_lookup_table_rows(self):
+        """
+        Test that chains sharing a temperature share the row of the lookup
+        table.
+        """
+
+        model = IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 0): 1}, h={1: 0.2})
+        temperatures = [0.5, 1, 2] * 100
+
+        _, _, table, rows = GibbsSampler().lookup_table(model.compile(), temperatures, 300)
+
+        assert len(table) == 3
+        assert rows.tolist() == [0, 1, 2] * 100
+
+    def test_temperature_vector(self):
+        """
+        Test that a single chain samples the same at a temperature given as
+        a vector of one entry, with and without the lookup table.
+        """
+
+        models = [
+            IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 0): 1}, h={1: 0.2}),
+            IsingModel(J={(0, 1): math.pi, (1, 2): -1, (2, 0): math.e}, h={1: 0.2}),
+        ]
+        as_counts = lambda pool: sorted((s.as_tuple, s.occurences) for s in pool)
+
+        for model in models:
+            results = [
+                GibbsSampler(seed=13, jit=False).sample(model, 100, temperature=temperature)
+                for temperature in (1.5, [1.5])
+            ]
+
+            assert as_counts(results[0]) == as_counts(results[1])
+
+    def test_kernel_sweeper_matches_site_sweeper(self):
+        """
+        Test that the kernel loops update the spins exactly as the site
+        sweeps do from the same seed, whether compiled or not.
+        """
+
+        models = [
+            IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 0): 1}, h={1: 0.2}),
+            IsingModel(J={(0, 1): math.pi, (1, 2): -1, (2, 0): math.e}, h={1: 0.2}),
+        ]
+
+        for model in models:
+            compiled = model.compile()
+            results = []
+
+            for sweeper in ('kernel_sweeper', 'site_sweeper'):
+                sampler = GibbsSampler(seed=11, jit=False)
+                spins = sampler.initial_state(compiled, 3)
+                sweep = getattr(sampler, sweeper)(compiled, [0.5, 1, 2], 3)
+
+                for _ in range(50):
+                    sweep(spins)
+                results.append(spins.tolist())
+
+            assert results[0] == results[1]
+
+    def test_checkpoint_resume(self, tmpdir):
+        """
+        Test that a run interrupted after a checkpoint resumes to the same
+        samples as an uninterrupted one, also for parallel tempering, whose
+        swaps depend on the position in the run.
+        """
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupted(sampler_class, interruption):
+            class InterruptedSampler(sampler_class):
+                saves = 0
+
+                def save_checkpoint(self, *args):
+                    sampler_class.save_checkpoint(self, *args)
+                    self.saves += 1
+                    if self.saves == interruption:
+                        raise Interrupted()
+
+            return InterruptedSampler
+
+        model = IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 0): 1}, h={1: 0.2})
+        as_counts = lambda pool: sorted((s.as_tuple, s.occurences) for s in pool)
+
+        configurations = [
+            (GibbsSampler, dict(), 3),
+            (TemperingSampler, dict(n_replicas=3, step=1), 1),
+            (TemperingSampler, dict(n_replicas=3, step=1), 2),
+            (TemperingSampler, dict(n_replicas=3, step=3), 3),
+        ]
+
+        for position, (sampler_class, options, interruption) in enumerate(configurations):
+            checkpoint = str(tmpdir.join('run{}.npz'.format(position)))
+            expected = sampler_class(seed=7, **options).sample(model, 300, n_chains=3)
+
+            with pytest.raises(Interrupted):
+                interrupted(sampler_class, interruption)(
+                    seed=7, checkpoint_interval=0, **options
+                ).sample(model, 300, n_chains=3, checkpoint=checkpoint)
+
+            resumed = sampler_class(**options).resume(model, checkpoint)
+            assert as_counts(resumed) == as_counts(expected)
+
+            # A finished run is saved as well
+            assert as_counts(sampler_class(**options).resume(model, checkpoint)) == \
+                as_counts(expected)
+
+        # The checkpoint only resumes for a model of the same variables
+        with pytest.raises(ValueError):
+            larger = IsingModel(J={(0, 1): 0.5, (1, 2): -1, (2, 3): 0.3, (3, 4): 1}, h={1: 0.2})
+            GibbsSampler().resume(larger, checkpoint)
+
+
+class TestTemperingSampler(object):
+
+    def test_biased_checkerboard(self):
+        """
+        Test that the low temperature replica of the biased checkerboard
+        returns only one solution, and that swap statistics are reported.
+        """
+
+        sampler = TemperingSampler(n_variables=4, n_replicas=4, max_temperature=10)
+        biased_checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={0: 20})
+        result = sampler.sample(biased_checkerboard, 1000, temperature=0.1)
+
+        solutions = [s.as_tuple for s in result]
+        assert solutions == [(-1, 1, -1, 1)]
+
+        assert len(result.diagnostics['temperatures']) == 4
+        assert len(result.diagnostics['swap_acceptance']) == 3
+        assert all(0 <= rate <= 1 for rate in result.diagnostics['swap_acceptance'])
+
+    def test_parallel_swap_statistics(self):
+        """
+        Test that the swap statistics of several workers are combined.
+        """
+
+        sampler = TemperingSampler(n_variables=4, n_replicas=3, n_jobs=2, seed=1)
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={})
+        result = sampler.sample(checkerboard, 200)
+
+        assert len(result.diagnostics['temperatures']) == 3
+        assert len(result.diagnostics['swap_acceptance']) == 2
+        assert all(0 < rate <= 1 for rate in result.diagnostics['swap_acceptance'])
+
+    def test_swap_interval(self):
+        """
+        Test that every pair of neighbouring temperatures is proposed swaps
+        when they are not proposed after every sweep.
+        """
+
+        sampler = TemperingSampler(n_replicas=4, swap_interval=2, seed=5)
+        frustrated = IsingModel(
+            J={(0, 1): 1, (1, 2): 1, (2, 0): 1, (2, 3): -1, (3, 4): 1, (4, 0): 1},
+            h={1: 0.5}
+        )
+        result = sampler.sample(frustrated, 500)
+
+        assert all(attempts > 0 for attempts in result.diagnostics['swap_attempts'])
+        assert all(0 < rate <= 1 for rate in result.diagnostics['swap_acceptance'])
+
+    def test_unattempted_swaps(self):
+        """
+        Test that pairs without attempted swaps have no acceptance rate.
+        """
+
+        diagnostics = TemperingSampler(n_replicas=3).swap_diagnostics(1, [4, 0], [2, 0])
+
+        assert diagnostics['swap_attempts'] == [4, 0]
+        assert diagnostics['swap_acceptance'][0] == 0.5
+        assert math.isnan(diagnostics['swap_acceptance'][1])
+
+
+class TestAnnealingSampler(object):
+
+    def test_unbiased_checkerboard(self):
+        """
+        Test that annealing the checkerboard finds both ground states.
+        """
+
+        sampler = AnnealingSampler(n_sweeps=100, beta_range=(0.1, 10))
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={})
+        result = sampler.sample(checkerboard, 1000)
+
+        solutions = [s.as_tuple for s in result]
+        assert len(result) == 1000
+        assert set(solutions) == set([(-1, 1, -1, 1), (1, -1, 1, -1)])
+
+    def test_explicit_schedule(self):
+        """
+        Test that an explicit schedule of inverse temperatures is used as is.
+        """
+
+        sampler = AnnealingSampler(schedule=[0.1, 0.5, 1, 2])
+        checkerboard = IsingModel(J={(0, 1): 1, (1, 2): 1, (2, 3): 1, (3, 0): 1}, h={})
+
+        assert list(sampler.betas(checkerboard.compile())) == [0.1, 0.5, 1, 2]
+
+        with pytest.raises(ValueError):
+            AnnealingSampler(schedule='exponential')
+
+
+class TestContrastiveDivergence(object):
+
+    def test_recovers_coefficients(self):
+        """
+        Test that fitting a model to exact Boltzmann frequencies of another
+        one with the same structure recovers its coefficients.
+        """
+
+        J = {(0, 1): -0.8, (1, 2): 0.5, (2, 3): -0.3, (3, 0): 0.4}
+        h = {0: 0.3, 2: -0.5}
+        target = IsingModel(J, h)
+
+        states = [[(number >> bit & 1) * 2 - 1 for bit in range(4)] for number in range(16)]
+        weights = [math.exp(-IsingSample(target, state).energy) for state in states]
+        data = SamplePool([
+            IsingSample(target, state, int(round(10 ** 6 * weight / sum(weights))))
+            for state, weight in zip(states, weights)
+        ])
+
+        model = IsingModel({edge: 0 for edge in J}, {variable: 0 for variable in range(4)})
+        learner = ContrastiveDivergence(GibbsSampler(method='block', seed=1),
+                                        n_chains=200, learning_rate=0.1)
+        learner.fit(model, data, 1000)
+
+        for edge, coupling in J.items():
+            assert model.J[edge] == pytest.approx(coupling, abs=0.1)
+        for variable in range(4):
+            assert model.h[variable] == pytest.approx(h.get(variable, 0), abs=0.1)
+
+        # The compiled form follows the updated coefficients
+        state = [1, -1, -1, 1]
+        assert IsingSample(model, state).energy == \
+            pytest.approx(IsingModel(dict(model.J), dict(model.h)).compile().energy(state))